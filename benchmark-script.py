@@ -0,0 +1,262 @@
+import argparse
+import datetime
+import decimal
+import importlib.util
+import json
+import logging
+import os
+import random
+import resource
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+#validator-script.py isn't importable by name, load it from next to this file
+_validator_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "validator-script.py")
+_spec = importlib.util.spec_from_file_location("validator", _validator_path)
+validator = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(validator)
+
+logger = validator.logger
+
+#synthetic tables: columns (in table order) and the pk the validator sorts and merges them by
+TABLES = {
+    "block_metadata": (["rowid", "height", "block_hash", "time", "num_txs", "proposer_address"], ["height"]),
+    "txn_fact_table": (["rowid", "height", "tx_index", "tx_hash", "code", "gas_wanted", "gas_used", "fee"], ["height", "tx_index"]),
+    "msg_fact_table": (["msg_rowid", "tx_hash", "msg_index", "type"], ["tx_hash", "msg_index"]),
+    "msgsend": (["rowid", "height", "hash", "index", "from_address", "to_address", "amount", "denom"], ["height", "hash", "index"]),
+    "balances": (["rowid", "address", "denom", "amount"], ["address", "denom"]),
+}
+
+DENOMS = ["uatom", "uosmo", "ujuno", "stake"]
+
+#sequence backed surrogate columns, excluded by the validator's table registry, see load_schema
+SURROGATE_COLUMNS = ("rowid", "msg_rowid")
+
+#postgres types of the synthetic columns, used when loading a database
+PG_TYPES = {int: "bigint", str: "text", decimal.Decimal: "numeric", datetime.datetime: "timestamptz"}
+
+def address(rng):
+    return "cosmos1" + "".join(rng.choice("023456789acdefghjklmnpqrstuvwxyz") for _ in range(38))
+
+def tx_hash(rng):
+    return "%064X" % rng.getrandbits(256)
+
+#generates the rows of every synthetic table for a chain of blocks heights, ordered by pk like the validator queries them
+#returns {table_name: rows} with rows as tuples in TABLES column order, rowid left as None
+def generate_chain(blocks, seed):
+    rng = random.Random(seed)
+    addresses = [address(rng) for _ in range(max(blocks // 2, 10))]
+    tables = {table_name: [] for table_name in TABLES}
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    for height in range(1, blocks + 1):
+        num_txs = rng.randint(0, 4)
+        tables["block_metadata"].append((None, height, tx_hash(rng), start + datetime.timedelta(seconds=6 * height),
+                                         num_txs, rng.choice(addresses)))
+        for tx_index in range(num_txs):
+            hash_ = tx_hash(rng)
+            gas_wanted = rng.randint(80000, 300000)
+            tables["txn_fact_table"].append((None, height, tx_index, hash_, 0, gas_wanted, gas_wanted - rng.randint(0, 50000),
+                                             decimal.Decimal(rng.randint(1, 10000)) / 100))
+            for msg_index in range(rng.randint(1, 3)):
+                tables["msg_fact_table"].append((None, hash_, msg_index, "msgsend"))
+                tables["msgsend"].append((None, height, hash_, msg_index, rng.choice(addresses), rng.choice(addresses),
+                                          decimal.Decimal(rng.randint(1, 10 ** 9)), rng.choice(DENOMS)))
+    for holder in addresses:
+        for denom in rng.sample(DENOMS, rng.randint(1, len(DENOMS))):
+            tables["balances"].append((None, holder, denom, decimal.Decimal(rng.randint(0, 10 ** 12))))
+    for table_name, (columns, pk) in TABLES.items():
+        key = validator.key_getter(columns, pk)
+        tables[table_name].sort(key=key)
+    return tables
+
+#derives the py and rs sides of rows, about mismatch_rate of the rows are dropped from one side or get a changed value on rs
+#rowids are numbered independently per side so they differ like they do between the real indexers
+def split_sides(columns, pk, rows, mismatch_rate, rng):
+    mutable = [index for index, column in enumerate(columns) if column not in pk and column not in SURROGATE_COLUMNS]
+    py_rows = []
+    rs_rows = []
+    for row in rows:
+        py_row = row
+        rs_row = row
+        if rng.random() < mismatch_rate:
+            action = rng.randrange(3)
+            if action == 0:
+                py_row = None
+            elif action == 1:
+                rs_row = None
+            else:
+                index = rng.choice(mutable)
+                value = row[index]
+                if isinstance(value, str):
+                    value = value + "x"
+                elif isinstance(value, datetime.datetime):
+                    value = value + datetime.timedelta(seconds=1)
+                else:
+                    value = value + 1
+                rs_row = row[:index] + (value,) + row[index + 1:]
+        if py_row is not None:
+            py_rows.append((len(py_rows) + 1,) + py_row[1:])
+        if rs_row is not None:
+            rs_rows.append((len(rs_rows) + 1001,) + rs_row[1:])
+    return py_rows, rs_rows
+
+def generate(blocks, mismatch_rate, seed):
+    rng = random.Random(seed + 1)
+    sides = {}
+    for table_name, rows in generate_chain(blocks, seed).items():
+        columns, pk = TABLES[table_name]
+        sides[table_name] = split_sides(columns, pk, rows, mismatch_rate, rng)
+    return sides
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    return resource.getrusage(who).ru_maxrss
+
+#runs check_lists over the in-memory sides of every table, rowids included since the rows aren't projected
+def bench_check_lists(sides, repeat):
+    results = []
+    for table_name, (py_rows, rs_rows) in sides.items():
+        columns, pk = TABLES[table_name]
+        best = None
+        for _ in range(repeat):
+            reporter = validator.MismatchReporter(log_samples=False)
+            start = time.perf_counter()
+            mismatches = validator.check_lists(py_rows, rs_rows, pk, table_name, "py", "rs", columns, columns, reporter,
+                                               SURROGATE_COLUMNS)
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+        rows = len(py_rows) + len(rs_rows)
+        results.append({"phase": "check_lists", "table": table_name, "rows": rows, "mismatches": mismatches,
+                        "wall_s": best, "rows_per_s": rows / best if best else None, "peak_rss_kb": peak_rss_kb()})
+    return results
+
+#(re)creates the synthetic tables in schema, plus the module_state table the validator expects, so that a whole
+#validator run works against it, rowids are bigserial like in the indexers so that the registry excludes them
+def load_schema(conn, schema, tables):
+    from psycopg2.extras import execute_values
+
+    with conn, conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {schema};")
+        for table_name, rows in tables.items():
+            columns, pk = TABLES[table_name]
+            types = [PG_TYPES[type(value)] for value in rows[0]] if rows else ["text"] * len(columns)
+            types[0] = "bigserial"
+            cursor.execute(f"""
+                            CREATE TABLE {schema}.{table_name} (
+                                {", ".join(f"{column} {pg_type}" for column, pg_type in zip(columns, types))},
+                                PRIMARY KEY ({", ".join(pk)})
+                            );
+                            """)
+            execute_values(cursor, f"INSERT INTO {schema}.{table_name} VALUES %s", rows, page_size=10000)
+        cursor.execute(f"CREATE TABLE {schema}.module_state (module_name text PRIMARY KEY, last_update_height bigint);")
+        cursor.execute(f"INSERT INTO {schema}.module_state VALUES ('balances', %s);",
+                       (max((row[1] for row in tables["block_metadata"]), default=0),))
+
+#runs validator-script.py against the loaded schemas, the per table figures are read from its --metrics-json output:
+#wall_s of a table is the slower side's query time plus the time the merge spent comparing and waiting for rows
+def bench_validator(sides, py_schema, rs_schema, validator_args):
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics_path = os.path.join(tmp, "metrics.json")
+        command = [sys.executable, _validator_path, "--py-schema", py_schema, "--rs-schema", rs_schema,
+                   "--metrics-json", metrics_path, *validator_args]
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wall = time.perf_counter() - start
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+
+    results = []
+    for table_name, table in sorted(metrics["tables"].items()):
+        reads = [table.get(side, {}) for side in ("py", "rs", "server")]
+        compare = table.get("compare", {})
+        rows = sum(read.get("rows", 0) for read in reads)
+        table_wall = (max(read.get("query_seconds", 0) + read.get("digest_seconds", 0) for read in reads)
+                      + compare.get("compare_seconds", 0) + sum(read.get("wait_seconds", 0) for read in reads))
+        results.append({"phase": "validator", "table": table_name, "rows": rows,
+                        "mismatches": metrics["mismatches"]["tables"].get(table_name, {}).get("total", 0), "wall_s": table_wall,
+                        "rows_per_s": rows / table_wall if table_wall else None, "peak_rss_kb": compare.get("process_max_rss_kb")})
+    rows = sum(len(py_rows) + len(rs_rows) for py_rows, rs_rows in sides.values())
+    results.append({"phase": "validator", "table": "all", "rows": rows, "mismatches": metrics["mismatches"]["total"], "wall_s": wall,
+                    "rows_per_s": rows / wall, "peak_rss_kb": peak_rss_kb(resource.RUSAGE_CHILDREN)})
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(_validator_path)).stdout.strip() or None
+    except OSError:
+        return None
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline is not None:
+        previous = {(result["phase"], result["table"]): result for result in baseline["results"]}
+    print(f"{'phase':<12} {'table':<16} {'rows':>10} {'wall_s':>9} {'rows/s':>12} {'peak_rss_kb':>12} {'vs baseline':>12}")
+    for result in results:
+        speedup = ""
+        before = previous.get((result["phase"], result["table"]))
+        if before is not None and before["wall_s"] and result["wall_s"]:
+            speedup = f"{before['wall_s'] / result['wall_s']:.2f}x"
+        print(f"{result['phase']:<12} {result['table']:<16} {result['rows']:>10} {result['wall_s']:>9.3f} "
+              f"{result['rows_per_s'] or 0:>12,.0f} {result['peak_rss_kb'] or '':>12} {speedup:>12}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the validator on synthetic indexer data")
+    parser.add_argument("--blocks", type=int, default=20000, help="number of synthetic blocks, the other tables scale with it")
+    parser.add_argument("--mismatch-rate", type=float, default=0.001,
+                        help="fraction of rows dropped from one side or changed on the rs side")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="check_lists runs per table, the fastest one is reported, at least 1")
+    parser.add_argument("--load", action="store_true",
+                        help="load the synthetic data into --py-schema/--rs-schema of the local database and time a validator run")
+    parser.add_argument("--dsn", default="dbname=indexerdb user=postgres password=postgres host=localhost port=5432",
+                        help="database the schemas are loaded into, the validator's own connection settings must point at it")
+    parser.add_argument("--py-schema", default="bench_py")
+    parser.add_argument("--rs-schema", default="bench_rs")
+    parser.add_argument("--validator-args", default="", help="extra arguments for the validator run, e.g. --validator-args=\"--workers 4\"")
+    parser.add_argument("--output", help="write the results as json, to be passed as --baseline of a later run")
+    parser.add_argument("--baseline", help="results json of an earlier run (e.g. another commit) to compare against")
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    return args
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    start = time.perf_counter()
+    sides = generate(args.blocks, args.mismatch_rate, args.seed)
+    results = [{"phase": "generate", "table": "all", "rows": sum(len(py) + len(rs) for py, rs in sides.values()),
+                "mismatches": None, "wall_s": time.perf_counter() - start, "rows_per_s": None, "peak_rss_kb": peak_rss_kb()}]
+    results[0]["rows_per_s"] = results[0]["rows"] / results[0]["wall_s"]
+
+    results += bench_check_lists(sides, args.repeat)
+
+    if args.load:
+        import psycopg2
+
+        conn = psycopg2.connect(args.dsn)
+        try:
+            load_schema(conn, args.py_schema, {table_name: py_rows for table_name, (py_rows, _) in sides.items()})
+            load_schema(conn, args.rs_schema, {table_name: rs_rows for table_name, (_, rs_rows) in sides.items()})
+        finally:
+            conn.close()
+        results += bench_validator(sides, args.py_schema, args.rs_schema, shlex.split(args.validator_args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "blocks": args.blocks, "mismatch_rate": args.mismatch_rate,
+                       "seed": args.seed, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,413 +1,1676 @@
+import argparse
+import collections
+import cProfile
+import csv
+import itertools
+import json
 import logging
+import math
+import multiprocessing
+import operator
+import os
+import random
+import queue
+import resource
+import select
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ, QueryCanceledError
 from psycopg2.extras import RealDictCursor
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
-tx_msg_type = [
-    'msggrant',
-    'msgexec',
-    'msgrevoke',
-    'msgsend',
-    'msgmultisend',
-    'msgverifyinvariant',
-    'msgsetwithdrawaddress',
-    'msgwithdrawdelegatorreward',
-    'msgwithdrawvalidatorcommission',
-    'msgfundcommunitypool',
-    'msgsubmitevidence',
-    'msggrantallowance',
-    'msgrevokeallowance',
-    'msgsubmitproposal',
-    'msgvoteproposal',
-    'msgdepositproposal',
-    'msgvoteweightedproposal',
-    'msgunjail',
-    'msgdelegate',
-    'msgbeginredelegate',
-    'msgundelegate',
-    'msgcancelunbondingdelegation'
-]
+#errors after which a query is run again on a new connection: dropped connections, and statement timeouts
+#(QueryCanceledError, which aborts the transaction the validation runs in), see with_reconnect
+RETRY_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+#longest wait between two reconnect attempts
+MAX_BACKOFF = 60.0
+
+#settings the text of values depends on, pinned for every session so that both servers render a row the same way
+#whatever their own configuration, the bucket digests hash the row text, see get_bucket_digests
+SESSION_SETTINGS = {
+    "TimeZone": "UTC",
+    "DateStyle": "ISO,YMD",
+    "IntervalStyle": "postgres",
+    "extra_float_digits": "1",
+    "bytea_output": "hex",
+}
 
 
 class IndexerDatabase:
-    def __init__(self, db_name, user, password, host, port):
+    #schema, if given, becomes the search_path of the connection, for indexers sharing one database
+    #connecting is attempted retries more times, waiting backoff seconds doubled after every failed attempt
+    def __init__(self, db_name, user, password, host, port, schema=None, retries=0, backoff=1.0):
 
         self._PG_DB = db_name
         self._PG_USER = user
         self._PG_PW = password
         self._PG_HOST = host
         self._PG_PORT = port
+        self._PG_SCHEMA = schema
+        self.retries = retries
+        self.backoff = backoff
+        #session of begin_snapshot_session, restored by reconnect
+        self._snapshot_session = False
+        self._snapshot = None
 
         try:
-            self.conn = psycopg2.connect(database=self._PG_DB,
-                                                user=self._PG_USER,
-                                                password=self._PG_PW,
-                                                host=self._PG_HOST,
-                                                port=self._PG_PORT)
-            logger.info(f"Successfully connected to {db_name}")
+            self.conn = self.connect()
         except psycopg2.OperationalError as e:
             logger.error(f"Couldn't connect to {db_name}: {e}")
+            raise
+        logger.info(f"Successfully connected to {db_name}")
+
+    def connect(self):
+        options = [f"-c {name}={value}" for name, value in SESSION_SETTINGS.items()]
+        if self._PG_SCHEMA:
+            options.append(f"-c search_path={self._PG_SCHEMA}")
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return psycopg2.connect(database=self._PG_DB,
+                                        user=self._PG_USER,
+                                        password=self._PG_PW,
+                                        host=self._PG_HOST,
+                                        port=self._PG_PORT,
+                                        options=" ".join(options))
+            except psycopg2.OperationalError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Couldn't connect to {self._PG_DB} (attempt {attempt + 1}/{self.retries + 1}), retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+
+    #replaces a broken connection and restores its snapshot session
+    #an imported snapshot is imported again if its exporting transaction is still open, the snapshot of
+    #the connection's own transaction is lost with it, so validation continues on a newer snapshot
+    def reconnect(self):
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+        self.conn = self.connect()
+        logger.info(f"Reconnected to {self._PG_DB}")
+        if not self._snapshot_session:
+            return
+        try:
+            self._begin_session()
+        except psycopg2.Error as e:
+            logger.warning(f"Couldn't import snapshot {self._snapshot} again on {self._PG_DB}, continuing on a new snapshot: {e}")
+            self.conn.rollback()
+            self._snapshot = None
+            self._begin_session()
+        if self._snapshot is None:
+            logger.warning(f"{self._PG_DB}: rows committed since the validation started may be seen from now on")
+
+    #all validation runs inside one read-only REPEATABLE READ transaction per database
+    #snapshot, if given, is one exported by export_snapshot on another connection, and is imported
+    def begin_snapshot_session(self, snapshot=None):
+        self._snapshot_session = True
+        self._snapshot = snapshot
+        self._begin_session()
+
+    def _begin_session(self):
+        self.conn.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+        if self._snapshot is not None:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SET TRANSACTION SNAPSHOT %s;", (self._snapshot,))
+
+    #identifies the database and schema, e.g. to tell whether a cached table registry was built for it
+    def source(self):
+        return f"{self._PG_HOST}:{self._PG_PORT}/{self._PG_DB}/{self._PG_SCHEMA or ''}"
+
+    #keyword arguments to open another IndexerDatabase on the same database, e.g. in a worker process
+    def connect_args(self):
+        return {"db_name": self._PG_DB, "user": self._PG_USER, "password": self._PG_PW,
+                "host": self._PG_HOST, "port": self._PG_PORT, "schema": self._PG_SCHEMA,
+                "retries": self.retries, "backoff": self.backoff}
+
+#runs fn(db.conn), reconnecting db and running fn again after a dropped connection
+#fn must be safe to run again, e.g. a read query whose rows are only used once fn returns
+#the same query would only time out again, so after a statement timeout fn is only run again if on_timeout, if given,
+#made it cheaper (e.g. a smaller page) and returned True
+def with_reconnect(db, fn, on_timeout=None):
+    attempt = 0
+    while True:
+        try:
+            return fn(db.conn)
+        except RETRY_ERRORS as e:
+            attempt += 1
+            if attempt > db.retries:
+                raise
+            if isinstance(e, QueryCanceledError) and (on_timeout is None or not on_timeout()):
+                raise
+            logger.warning(f"Query on {db._PG_DB} failed, reconnecting (retry {attempt}/{db.retries}): {e}")
+            db.reconnect()
+
+#default number of rows pulled per round trip from a server-side cursor
+BATCH_SIZE = 10000
+
+_cursor_ids = itertools.count()
+
+#tables without a height column of their own, restricted to a height range through their parent transaction
+HEIGHT_FILTERS = {
+    "msg_fact_table": "tx_hash IN (SELECT tx_hash FROM {schema}txn_fact_table WHERE {condition})",
+}
+
+#table and column names come from the catalogs of either database, they are quoted wherever they go into a query
+#context is the connection or cursor the query runs on
+def quote(context, name):
+    return sql.Identifier(name).as_string(context)
+
+#selects the rows whose pk, salted with seed, hashes into the lowest fraction of the hash space
+#only key values are hashed, so the same keys are selected on both sides
+KeySample = collections.namedtuple("KeySample", ["seed", "fraction"])
+
+#sql condition and params restricting table_name to a selection of its rows, schema qualifies the other tables it refers to
+#selection is a [lo, hi) height range tuple, a list of sampled heights or a KeySample, context is the one of quote
+def row_filter(context, table_name, pk, selection, schema=None):
+    if isinstance(selection, KeySample):
+        key_text = " || ',' || ".join(f"{quote(context, key)}::text" for key in pk)
+        return (f"('x' || substr(md5(%s || ',' || {key_text}), 1, 8))::bit(32)::bigint < %s",
+                (str(selection.seed), int(selection.fraction * 2 ** 32)))
+    if isinstance(selection, list):
+        condition, params = "height = ANY(%s)", (selection,)
+    else:
+        condition, params = "height >= %s AND height < %s", tuple(selection)
+    prefix = f"{quote(context, schema)}." if schema else ""
+    return HEIGHT_FILTERS.get(table_name, "{condition}").format(schema=prefix, condition=condition), params
+
+#human readable description of a selection for the log
+def describe_selection(selection):
+    if isinstance(selection, KeySample):
+        return f"a {selection.fraction:.2%} key sample"
+    if isinstance(selection, list):
+        return f"{len(selection)} sampled heights"
+    return f"heights [{selection[0]}, {selection[1]})"
+
+#what the validator knows about a table from the catalogs of both databases, see build_registry
+#pk is the key the sides are merged by, columns are the compared columns (pk included), casts the CANONICAL_CASTS
+#key each of them is selected through on both sides, None for a plain column, rs_missing the columns the rs side
+#doesn't have, selected as NULL there, by_height marks tables having a height column
+#collate_keys are the text pk columns sorted with COLLATE "C", see key_order, unique_sides are the sides (py, rs)
+#having a unique index on the pk over not null columns, indexed_sides those having a btree index which serves
+#ORDER BY key_order, only sides that are both are scanned by keyset pagination, see scan_table
+TableSpec = collections.namedtuple("TableSpec", ["name", "pk", "by_height", "columns", "casts", "rs_missing", "collate_keys",
+                                                 "unique_sides", "indexed_sides"])
+
+#keys the tables of the indexers are known to be merged by, used for tables without a catalog key that has neither
+#surrogate nor nullable columns (e.g. only keyed on rowid) and for foreign tables, which have no indexes
+#nothing guarantees such a key is unique or not null, rows sharing a key show up as mismatches, see check_lists
+KNOWN_KEYS = {
+    "block_metadata": ["height"],
+    "txn_fact_table": ["height", "tx_index"],
+    "msg_fact_table": ["tx_hash", "msg_index"],
+    "balances": ["address", "denom"],
+    "denom_metadata": ["denom"],
+    "staked": ["address", "validator_address"],
+    "unstaking": ["address", "validator_address"],
+    "validator_metadata": ["validator_address"],
+    "account_txns": ["address"],
+}
+
+#key of the per message type tables (msgsend, msgdelegate, ...)
+MSG_TABLE_KEY = ["height", "hash", "index"]
+
+def known_key(table_name):
+    if table_name in KNOWN_KEYS:
+        return KNOWN_KEYS[table_name]
+    if table_name.startswith("msg"):
+        return MSG_TABLE_KEY
+    return None
+
+#collations sorting text in code point order, the order python compares strings in
+CODE_POINT_COLLATIONS = ("C", "POSIX", "C.UTF-8", "C.utf8", "ucs_basic")
+
+#casts applied on the server, so that heavy types cross the wire as cheap canonical text which is equal exactly
+#when the values are: jsonb text has normalized spacing and key order, numeric text has its trailing fractional zeros
+#(and a trailing point) stripped, as trim_scale would do, which only exists from postgres 13
+CANONICAL_CASTS = {
+    "json": "{column}::jsonb::text",
+    "jsonb": "{column}::jsonb::text",
+    "numeric": "CASE WHEN strpos({column}::numeric::text, '.') > 0 THEN rtrim(rtrim({column}::numeric::text, '0'), '.') "
+               "ELSE {column}::numeric::text END",
+}
+
+#the expressions selecting the compared columns of spec on side py or rs, context is the one of quote
+def select_expressions(context, spec, side):
+    expressions = []
+    for column, cast in zip(spec.columns, spec.casts):
+        if side == "rs" and column in spec.rs_missing:
+            expressions.append("NULL")
+        elif cast is not None:
+            expressions.append(CANONICAL_CASTS[cast].format(column=quote(context, column)))
+        else:
+            expressions.append(quote(context, column))
+    return expressions
+
+#"expression AS column, ..." list of the compared columns of spec on side py or rs
+def select_list(context, spec, side):
+    return ", ".join(expression if expression == quote(context, column) else f"{expression} AS {quote(context, column)}"
+                     for expression, column in zip(select_expressions(context, spec, side), spec.columns))
+
+#pk of spec as the list of an ORDER BY or a row comparison, the merge in check_lists compares keys as python values,
+#so text keys whose collation (e.g. en_US) orders them differently are sorted with COLLATE "C" on the server
+#such tables need an index on the key with COLLATE "C" to be paged by key, else they are scanned in one sorted query,
+#see scan_table
+def key_order(context, spec):
+    return ", ".join(f'{quote(context, key)} COLLATE "C"' if key in spec.collate_keys else quote(context, key) for key in spec.pk)
+
+#columns and unique keys of every table (or foreign table) in the first schema of the search_path of cursor
+#returns {table_name: {"columns": [(column, data_type, surrogate, collation)], "keys": [[column, ...]],
+#"indexes": [[(column, collation), ...]]}}, keys are the unique indexes on not null columns only, a null in a key
+#breaks the merge and the keyset pagination, ordered primary key first and then by width, indexes are the btree
+#indexes on plain columns, surrogate marks sequence or identity backed columns, which differ between the
+#indexers by construction, collation is the one text columns sort in (the database default resolved), None otherwise
+def get_schema_tables(cursor):
+    tables = {}
+    cursor.execute("""
+                    SELECT c.table_name, c.column_name, c.data_type,
+                           c.is_identity = 'YES' OR coalesce(c.column_default, '') LIKE 'nextval(%' AS surrogate,
+                           (SELECT CASE WHEN co.collname = 'default' THEN d.datcollate::text ELSE co.collname::text END
+                            FROM pg_attribute a
+                            JOIN pg_collation co ON co.oid = a.attcollation
+                            JOIN pg_database d ON d.datname = current_database()
+                            WHERE a.attrelid = format('%I.%I', c.table_schema, c.table_name)::regclass
+                                  AND a.attname = c.column_name) AS collation
+                    FROM information_schema.columns c
+                    JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+                    WHERE c.table_schema = current_schema() AND t.table_type IN ('BASE TABLE', 'FOREIGN')
+                    ORDER BY c.table_name, c.ordinal_position;
+                    """)
+    for row in cursor.fetchall():
+        table = tables.setdefault(row['table_name'], {"columns": [], "keys": [], "indexes": []})
+        table["columns"].append((row['column_name'], row['data_type'], row['surrogate'], row['collation']))
+    cursor.execute("""
+                    SELECT t.relname AS table_name, array_agg(a.attname::text ORDER BY k.ordinality) AS columns
+                    FROM pg_index i
+                    JOIN pg_class t ON t.oid = i.indrelid
+                    JOIN pg_namespace n ON n.oid = t.relnamespace
+                    CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ordinality)
+                    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+                    WHERE n.nspname = current_schema() AND i.indisunique AND i.indpred IS NULL AND i.indexprs IS NULL
+                    GROUP BY t.relname, i.indexrelid, i.indisprimary
+                    HAVING bool_and(a.attnotnull)
+                    ORDER BY t.relname, i.indisprimary DESC, count(*);
+                    """)
+    for row in cursor.fetchall():
+        if row['table_name'] in tables:
+            tables[row['table_name']]["keys"].append(row['columns'])
+    cursor.execute("""
+                    SELECT t.relname AS table_name, array_agg(a.attname::text ORDER BY k.ordinality) AS columns,
+                           array_agg(CASE WHEN co.collname = 'default' THEN d.datcollate::text ELSE co.collname::text END
+                                     ORDER BY k.ordinality) AS collations
+                    FROM pg_index i
+                    JOIN pg_class t ON t.oid = i.indrelid
+                    JOIN pg_namespace n ON n.oid = t.relnamespace
+                    JOIN pg_class ic ON ic.oid = i.indexrelid
+                    JOIN pg_am am ON am.oid = ic.relam
+                    JOIN pg_database d ON d.datname = current_database()
+                    CROSS JOIN LATERAL unnest(i.indkey::int2[], i.indcollation::oid[]) WITH ORDINALITY AS k(attnum, collation, ordinality)
+                    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+                    LEFT JOIN pg_collation co ON co.oid = k.collation
+                    WHERE n.nspname = current_schema() AND am.amname = 'btree' AND i.indpred IS NULL AND i.indexprs IS NULL
+                    GROUP BY t.relname, i.indexrelid;
+                    """)
+    for row in cursor.fetchall():
+        if row['table_name'] in tables:
+            tables[row['table_name']]["indexes"].append(list(zip(row['columns'], row['collations'])))
+    return tables
+
+#whether one of indexes serves ORDER BY key_order of pk: its leading columns are pk in that order, and the ones of
+#collate_keys are in a code point collation, without such an index every keyset page sorts the rest of the table
+def serves_key_order(indexes, pk, collate_keys):
+    return any([column for column, _ in index[:len(pk)]] == list(pk)
+               and all(collation in CODE_POINT_COLLATIONS for column, collation in index[:len(pk)] if column in collate_keys)
+               for index in indexes)
+
+#builds the TableSpec of every table present on both sides but skip, exclude are further columns never compared
+#the pk is the one given in keys (table_name: [column, ...]), else the first catalog key without surrogate columns,
+#of the py side first since foreign tables have no indexes, else the known key of the table, see known_key
+#raises ValueError naming the tables none of those apply to, instead of leaving them unvalidated
+#heavy columns are cast to canonical text (see CANONICAL_CASTS) where both sides have the same type
+def build_registry(py_cursor, rs_cursor, py_db_name, rs_db_name, exclude=(), keys=None, skip=()):
+    keys = keys or {}
+    py_tables = get_schema_tables(py_cursor)
+    rs_tables = get_schema_tables(rs_cursor)
+    registry = {}
+    unkeyed = []
+    for table_name in sorted(py_tables.keys() | rs_tables.keys()):
+        if table_name in skip:
+            continue
+        if table_name not in rs_tables:
+            logger.warning(f"{table_name} table only exists in {py_db_name}, it isn't validated")
+            continue
+        if table_name not in py_tables:
+            logger.warning(f"{table_name} table only exists in {rs_db_name}, it isn't validated")
+            continue
+        py_table = py_tables[table_name]
+        rs_table = rs_tables[table_name]
+        surrogates = {column for column, _, surrogate, _ in py_table["columns"] + rs_table["columns"] if surrogate} | set(exclude)
+        shared_columns = {column for column, _, _, _ in py_table["columns"]} & {column for column, _, _, _ in rs_table["columns"]}
+        pk = keys.get(table_name)
+        if pk is None:
+            pk = next((key for key in py_table["keys"] + rs_table["keys"] if not surrogates & set(key)), None)
+        if pk is None and known_key(table_name) is not None and set(known_key(table_name)) <= shared_columns:
+            pk = known_key(table_name)
+        if pk is None:
+            unkeyed.append(table_name)
+            continue
+        if not set(pk) <= shared_columns:
+            raise ValueError(f"Key {pk} of {table_name} table isn't made of columns both databases have")
+        surrogates -= set(pk)
+        rs_types = {column: data_type for column, data_type, _, _ in rs_table["columns"]}
+        columns = []
+        casts = []
+        for column, data_type, _, _ in py_table["columns"]:
+            if column in surrogates:
+                continue
+            columns.append(column)
+            cast_types = column not in pk and data_type in CANONICAL_CASTS and rs_types.get(column, data_type) == data_type
+            casts.append(data_type if cast_types else None)
+        #columns the rs side doesn't have only match when they are null
+        rs_missing = [column for column in columns if column not in rs_types]
+        by_height = any(column == "height" for column, _, _, _ in py_table["columns"])
+        collate_keys = sorted({column for column, _, _, collation in py_table["columns"] + rs_table["columns"]
+                               if column in pk and collation is not None and collation not in CODE_POINT_COLLATIONS})
+        unique_sides = [side for side, table in (("py", py_table), ("rs", rs_table))
+                        if any(set(key) == set(pk) for key in table["keys"])]
+        indexed_sides = [side for side, table in (("py", py_table), ("rs", rs_table))
+                         if serves_key_order(table["indexes"], pk, collate_keys)]
+        for side, db_name in (("py", py_db_name), ("rs", rs_db_name)):
+            if side not in unique_sides:
+                logger.info(f"{table_name} table has no unique index on {pk} in {db_name}, it is scanned with one sorted query "
+                            f"and rows sharing a key are reported as mismatches")
+            elif side not in indexed_sides:
+                order = ", ".join(f'{key} COLLATE "C"' if key in collate_keys else key for key in pk)
+                logger.warning(f"{table_name} table has no index on ({order}) in {db_name}, it is scanned with one sorted query "
+                               f"instead of keyset pages, which would each sort the rest of the table")
+        registry[table_name] = TableSpec(table_name, pk, by_height, columns, casts, rs_missing, collate_keys, unique_sides,
+                                         indexed_sides)
+    if unkeyed:
+        raise ValueError(f"No key without surrogate or nullable columns to merge {', '.join(unkeyed)} by, "
+                         f"pass --key <table>=<column>,... or --skip-table <table>")
+    return registry
+
+#md5 of what build_registry reads from the catalogs of cursor's schema: the columns with their types, collations,
+#nullability and defaults, and the indexes, a single cheap query, it changes with any migration of the tables
+def get_catalog_fingerprint(cursor):
+    cursor.execute("""
+                    SELECT md5(concat_ws(';',
+                        (SELECT string_agg(concat_ws(':', c.relname, a.attname, a.atttypid, a.attcollation, a.attnotnull,
+                                                     a.attidentity, pg_get_expr(d.adbin, d.adrelid)), ','
+                                           ORDER BY c.relname, a.attnum)
+                         FROM pg_class c
+                         JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+                         LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+                         WHERE c.relnamespace = current_schema()::text::regnamespace AND c.relkind IN ('r', 'p', 'f')),
+                        (SELECT string_agg(concat_ws(':', c.relname, i.indkey::text, i.indcollation::text, i.indisunique, i.indisprimary,
+                                                     i.indpred IS NULL, i.indexprs IS NULL), ','
+                                           ORDER BY c.relname, i.indkey::text)
+                         FROM pg_index i
+                         JOIN pg_class c ON c.oid = i.indrelid
+                         WHERE c.relnamespace = current_schema()::text::regnamespace))) AS fingerprint;
+                    """)
+    return cursor.fetchone()['fingerprint']
+
+#the registry cached in path, if it was built for the same sources, options and catalogs of both databases (see
+#get_catalog_fingerprint), else a newly built one which is cached in path, refresh rebuilds it regardless
+#without a path the registry is built every run
+def load_registry(py_cursor, rs_cursor, py_db, rs_db, path=None, refresh=False, exclude=(), keys=None, skip=()):
+    if path is None:
+        registry = build_registry(py_cursor, rs_cursor, py_db._PG_DB, rs_db._PG_DB, exclude, keys, skip)
+        logger.info(f"Built the table registry, {len(registry)} tables")
+        return registry
+    sources = {"py": py_db.source(), "rs": rs_db.source(), "exclude": sorted(exclude), "keys": keys or {}, "skip": sorted(skip),
+               "catalogs": [get_catalog_fingerprint(py_cursor), get_catalog_fingerprint(rs_cursor)],
+               "fields": list(TableSpec._fields)}
+    if not refresh and os.path.exists(path):
+        with open(path) as f:
+            cached = json.load(f)
+        if cached["sources"] == sources:
+            logger.info(f"Using the table registry cached in {path}")
+            return {table_name: TableSpec(**spec) for table_name, spec in cached["tables"].items()}
+    registry = build_registry(py_cursor, rs_cursor, py_db._PG_DB, rs_db._PG_DB, exclude, keys, skip)
+    logger.info(f"Built the table registry, {len(registry)} tables")
+    write_atomically(path, json.dumps({"sources": sources, "tables": {table_name: spec._asdict() for table_name, spec in registry.items()}},
+                                      indent=2))
+    return registry
+
+#module names in module_state, their state tables are rewritten in place and only validated at the latest height
+def get_state_tables(cursor):
+    cursor.execute("""
+                    SELECT module_name
+                    FROM module_state;
+                    """)
+    return {row['module_name'] for row in cursor.fetchall()}
+
+#per table and side timings and volumes of a run, exported as a prometheus textfile and a json summary
+#sides are py and rs for the reads and compare for the work done in the validator itself
+class RunMetrics:
+    #fields merged by taking the maximum instead of the sum
+    MAX_FIELDS = ("process_max_rss_kb",)
+
+    def __init__(self):
+        self.tables = {}
+
+    def side(self, table_name, side):
+        return self.tables.setdefault(table_name, {}).setdefault(side, collections.Counter())
+
+    #memory high-water mark of the whole (worker) process once table_name was validated, it never goes down, so it
+    #only tells which table raised it: the first one reaching a value, not every later one reporting the same
+    def record_memory(self, table_name):
+        stats = self.side(table_name, "compare")
+        stats["process_max_rss_kb"] = max(stats["process_max_rss_kb"], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    #hands the metrics over, e.g. from a worker process to the metrics of main()
+    def take(self):
+        tables = self.tables
+        self.tables = {}
+        return tables
+
+    def absorb(self, tables):
+        for table_name, sides in tables.items():
+            for side, values in sides.items():
+                stats = self.side(table_name, side)
+                for field, value in values.items():
+                    stats[field] = max(stats[field], value) if field in self.MAX_FIELDS else stats[field] + value
+
+    #estimates, if given, are the sampling mode mismatch rate estimates, see estimate_mismatch_rates
+    def export(self, json_path, prom_path, duration, mismatches, estimates=None):
+        if json_path is not None:
+            summary = {"duration_seconds": duration, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       "tables": {table_name: {side: dict(values) for side, values in sides.items()}
+                                  for table_name, sides in self.tables.items()},
+                       "mismatches": mismatches}
+            if estimates is not None:
+                summary["sampling_estimates"] = estimates
+            write_atomically(json_path, json.dumps(summary, indent=2, default=str))
+        if prom_path is not None:
+            lines = ["# HELP validator_run_duration_seconds Wall time of the validator run.",
+                     "# TYPE validator_run_duration_seconds gauge",
+                     f"validator_run_duration_seconds {duration}"]
+            fields = sorted({field for sides in self.tables.values() for values in sides.values() for field in values})
+            for field in fields:
+                name = f"validator_{field}"
+                lines.append(f"# TYPE {name} gauge")
+                for table_name, sides in sorted(self.tables.items()):
+                    for side, values in sorted(sides.items()):
+                        if field in values:
+                            lines.append(f'{name}{{table="{table_name}",side="{side}"}} {values[field]}')
+            lines.append("# TYPE validator_mismatches gauge")
+            for table_name, table in sorted(mismatches["tables"].items()):
+                for kind in ("missing", "inconsistent"):
+                    for detail, count in sorted(table[kind].items()):
+                        label = "database" if kind == "missing" else "column"
+                        lines.append(f'validator_mismatches{{table="{table_name}",kind="{kind}",{label}="{detail}"}} {count}')
+            if estimates is not None:
+                lines.append("# TYPE validator_sampled_mismatch_rate gauge")
+                for table_name, estimate in sorted(estimates.items()):
+                    for bound in ("rate", "low", "high"):
+                        if estimate[bound] is not None:
+                            lines.append(f'validator_sampled_mismatch_rate{{table="{table_name}",bound="{bound}"}} {estimate[bound]}')
+            write_atomically(prom_path, "\n".join(lines) + "\n")
+
+#readers such as the node_exporter textfile collector or the next incremental run must never see a half written file
+def write_atomically(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+#approximate bytes of a batch from the size of its first row, counting every non-text value as 8 bytes
+def estimate_bytes(rows):
+    if not rows:
+        return 0
+    return len(rows) * sum(len(value) if isinstance(value, (str, bytes, memoryview)) else 8 for value in rows[0])
+
+#adds a fetched batch to the rows/bytes counters of stats
+def count_batch(stats, rows):
+    stats["rows"] += len(rows)
+    stats["bytes_estimated"] += estimate_bytes(rows)
+
+#runs query on a named (server-side) cursor so at most batch_size rows are held in memory
+#returns the column names and a lazy iterator over the rows as plain tuples
+#with prefetch > 0 up to prefetch further batches are fetched on a background thread while the current one is consumed
+#stats, if given, gets query/fetch/wait seconds and rows/bytes added, wait_seconds is the time the consumer was blocked
+def stream_rows(conn, query, params=None, batch_size=BATCH_SIZE, prefetch=0, stats=None):
+    if stats is None:
+        stats = collections.Counter()
+    start = time.perf_counter()
+    cursor = conn.cursor(name=f"validator_cursor_{next(_cursor_ids)}")
+    cursor.itersize = batch_size
+    cursor.execute(query, params)
+    rows = cursor.fetchmany(batch_size)
+    stats["query_seconds"] += time.perf_counter() - start
+    count_batch(stats, rows)
+    columns = [column[0] for column in cursor.description]
+    fetch = lambda: cursor.fetchmany(batch_size)
+    if prefetch > 0:
+        return columns, prefetch_batches(fetch, rows, prefetch, stats, cursor.close)
+    return columns, iter_batches(fetch, rows, stats, cursor.close)
+
+#scans table_name in pk order a page of batch_size rows at a time, every page being a query for the rows after
+#the last key fetched, WHERE (pk) > (last key), so that no query outlives its page
+#a dropped connection or a statement timeout costs a single page: db is reconnected and the scan resumes after the
+#last key fetched, rows up to it were already handed on to the comparison, after a statement timeout it resumes
+#with smaller pages
+#only the compared columns of spec are selected, as on side py or rs, see select_list
+#returns the column names and a lazy iterator over the rows, selection, prefetch and stats are the same as for stream_rows
+def keyset_rows(db, spec, side, selection=None, batch_size=BATCH_SIZE, prefetch=0, stats=None):
+    table_name = spec.name
+    pk = spec.pk
+    if stats is None:
+        stats = collections.Counter()
+    #the query text is the same on any connection, it is built once on the first one
+    select_clause = select_list(db.conn, spec, side)
+    table = quote(db.conn, table_name)
+    conditions = []
+    params = ()
+    if selection is not None:
+        condition, params = row_filter(db.conn, table_name, pk, selection)
+        conditions.append(f"({condition})")
+    order = key_order(db.conn, spec)
+    after = f"({order}) > ({', '.join(['%s'] * len(pk))})"
+    columns = None
+    last_key = None
+    done = False
+    page_size = batch_size
+
+    #a page timing out is fetched again at half its size, later pages keep the smaller size
+    def shrink_page():
+        nonlocal page_size
+        if page_size == 1:
+            return False
+        page_size = max(page_size // 2, 1)
+        logger.warning(f"Page of {table_name} timed out, continuing with pages of {page_size} rows")
+        return True
+
+    def fetch():
+        nonlocal columns, last_key, done
+        #a short page is the last one, no query is needed to find out
+        if done:
+            return []
+        where = conditions if last_key is None else [*conditions, after]
+        query = f"""
+                SELECT {select_clause}
+                FROM {table}
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY {order}
+                LIMIT %s;
+                """
+
+        def run(conn):
+            with conn.cursor() as cursor:
+                cursor.execute(query, (*params, *(last_key or ()), page_size))
+                return [column[0] for column in cursor.description], cursor.fetchall()
+
+        columns, rows = with_reconnect(db, run, shrink_page)
+        if rows:
+            last_key = key_getter(columns, pk)(rows[-1])
+        done = len(rows) < page_size
+        return rows
+
+    start = time.perf_counter()
+    rows = fetch()
+    stats["query_seconds"] += time.perf_counter() - start
+    count_batch(stats, rows)
+    if prefetch > 0:
+        return columns, prefetch_batches(fetch, rows, prefetch, stats)
+    return columns, iter_batches(fetch, rows, stats)
+
+#streams the compared columns of the table of spec, or of its selection, ordered by pk from db of side py or rs
+#keyset pages through the table and resumes after connection drops, see keyset_rows, cursor runs a single query
+#on a server-side cursor, see stream_rows, which saves the per page planning but has to start over when it fails
+#keyset pagination skips the rows sharing the last key of a page and stops at a null key, and without an index serving
+#its order every page sorts the rest of the table, so sides without a unique index on the pk over not null columns or
+#without an index in key_order (see TableSpec) are scanned on a server-side cursor in any case
+def scan_table(db, spec, side, selection=None, batch_size=BATCH_SIZE, prefetch=0, stats=None, scan="keyset"):
+    if scan == "keyset" and side in spec.unique_sides and side in spec.indexed_sides:
+        return keyset_rows(db, spec, side, selection, batch_size, prefetch, stats)
+    where = ""
+    params = None
+    if selection is not None:
+        condition, params = row_filter(db.conn, spec.name, spec.pk, selection)
+        where = "WHERE " + condition
+    query = f"""
+            SELECT {select_list(db.conn, spec, side)}
+            FROM {quote(db.conn, spec.name)}
+            {where}
+            ORDER BY {key_order(db.conn, spec)};
+            """
+    return stream_rows(db.conn, query, params, batch_size, prefetch, stats)
+
+#fetch returns the next batch, an empty one once exhausted, close, if given, is called when the iteration ends
+def iter_batches(fetch, rows, stats, close=None):
+    try:
+        while rows:
+            yield from rows
+            start = time.perf_counter()
+            rows = fetch()
+            elapsed = time.perf_counter() - start
+            stats["fetch_seconds"] += elapsed
+            stats["wait_seconds"] += elapsed
+            count_batch(stats, rows)
+    finally:
+        if close is not None:
+            close()
+
+#fetch is only called by the fetching thread, the bounded queue caps memory at prefetch batches
+#and psycopg2 releases the GIL while waiting on the server, so fetching overlaps with the comparison
+def prefetch_batches(fetch, rows, prefetch, stats, close=None):
+    batches = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_ahead():
+        try:
+            batch = rows
+            while batch and put(batch):
+                start = time.perf_counter()
+                batch = fetch()
+                stats["fetch_seconds"] += time.perf_counter() - start
+                count_batch(stats, batch)
+        except Exception as e:
+            put(e)
+        else:
+            put(None)
+        finally:
+            if close is not None:
+                close()
+
+    fetcher = threading.Thread(target=fetch_ahead, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            batch = batches.get()
+            stats["wait_seconds"] += time.perf_counter() - start
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        fetcher.join()
+
+#builds a function returning the values at indexes of a row as a tuple
+def tuple_getter(indexes):
+    if not indexes:
+        return lambda row: ()
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    return operator.itemgetter(*indexes)
+
+#stands for a null key value, it equals itself only and sorts after every other value, as NULL does in ORDER BY
+class NullKey:
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return other is not self
+
+    def __repr__(self):
+        return "None"
+
+NULL_KEY = NullKey()
+
+#builds a function returning the pk values of a row as a native typed tuple, ordered the same way as ORDER BY key_order
+#with nullable, null values are NULL_KEY, so that keys with nulls can still be ordered
+def key_getter(columns, pk, nullable=False):
+    getter = tuple_getter([columns.index(key) for key in pk])
+    if not nullable:
+        return getter
+    return lambda row: tuple(NULL_KEY if value is None else value for value in getter(row))
+
+#the key as reported, NULL_KEY values back to None
+def reported_key(key):
+    return tuple(None if value is NULL_KEY else value for value in key)
+
+#resolves column positions once per table, the two sides may list their columns in a different order
+#returns the key extractor of each side, extractors of the values compared on both sides,
+#(column, py index, rs index) of those shared columns and (column, py index) of columns missing on the rs side
+#excluded columns are never compared, rows projected through the table registry don't have them in the first place
+def plan_comparison(py_columns, rs_columns, pk, excluded=(), nullable_keys=False):
+    rs_indexes = {column: index for index, column in enumerate(rs_columns)}
+    shared = []
+    py_only = []
+    for index, column in enumerate(py_columns):
+        if column in excluded:
+            continue
+        if column in rs_indexes:
+            shared.append((column, index, rs_indexes[column]))
+        else:
+            py_only.append((column, index))
+    py_values = tuple_getter([py_index for _, py_index, _ in shared])
+    rs_values = tuple_getter([rs_index for _, _, rs_index in shared])
+    return (key_getter(py_columns, pk, nullable_keys), key_getter(rs_columns, pk, nullable_keys), py_values, rs_values,
+            shared, py_only)
+
+#collects the inconsistencies found by check_lists and server_diff_table
+#every inconsistency is counted per (table, kind, column or database) but only the first sample_cap of each are kept
+#as samples, those are written in batches of flush_every records to path as jsonl or csv, or logged if there is no path
+#with track_heights the heights of inconsistent keys having a height are collected per table, see estimate_mismatch_rates
+class MismatchReporter:
+    def __init__(self, path=None, fmt="jsonl", sample_cap=1000, flush_every=10000, log_samples=True, track_heights=False):
+        self.path = path
+        self.fmt = fmt
+        self.sample_cap = sample_cap
+        self.flush_every = flush_every
+        self.log_samples = log_samples
+        self.track_heights = track_heights
+        self.counts = collections.Counter()
+        self.stored = collections.Counter()
+        self.heights = {}
+        self._buffer = []
+        self._file = None
+        self._writer = None
+
+    def missing(self, table_name, pk, key, db_name):
+        counter_key = (table_name, "missing", db_name)
+        self.counts[counter_key] += 1
+        self._track(table_name, pk, key)
+        if self.stored[counter_key] < self.sample_cap:
+            self._store(counter_key, {"table": table_name, "kind": "missing", "database": db_name, "column": None,
+                                      "pk": pk, "key": list(key)})
+
+    def inconsistent(self, table_name, pk, key, column):
+        counter_key = (table_name, "inconsistent", column)
+        self.counts[counter_key] += 1
+        self._track(table_name, pk, key)
+        if self.stored[counter_key] < self.sample_cap:
+            self._store(counter_key, {"table": table_name, "kind": "inconsistent", "database": None, "column": column,
+                                      "pk": pk, "key": list(key)})
+
+    def _track(self, table_name, pk, key):
+        if self.track_heights and "height" in pk:
+            self.heights.setdefault(table_name, set()).add(key[pk.index("height")])
+
+    def _store(self, counter_key, record):
+        self.stored[counter_key] += 1
+        if self.path is None and self.log_samples:
+            if record["kind"] == "missing":
+                logger.error(f"Couldn't find data corresponding to {record['pk']}: {tuple(record['key'])} in {record['table']} table of {record['database']}")
+            else:
+                logger.error(f"Inconsistent {record['column']} at {record['pk']}: {tuple(record['key'])} in {record['table']} table")
+            return
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    #without a path the samples stay buffered until take() hands them over
+    def flush(self):
+        if not self._buffer or self.path is None:
+            return
+        if self._file is None:
+            self._file = open(self.path, "w", newline="")
+            if self.fmt == "csv":
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(["table", "kind", "database", "column", "pk", "key"])
+        if self.fmt == "csv":
+            self._writer.writerows([record["table"], record["kind"], record["database"], record["column"],
+                                    ",".join(record["pk"]), json.dumps(record["key"], default=str)] for record in self._buffer)
+        else:
+            self._file.write("".join(json.dumps(record, default=str) + "\n" for record in self._buffer))
+        self._buffer = []
+
+    #hands the counts, unwritten samples and tracked heights over, e.g. from a worker process to the reporter of main()
+    def take(self):
+        counts, records, heights = self.counts, self._buffer, self.heights
+        self.counts = collections.Counter()
+        self.stored = collections.Counter()
+        self.heights = {}
+        self._buffer = []
+        return counts, records, heights
 
-#to check and log inconsistencies in list of dict returned by psycopg2
-#pk should be a list of keys which form primary key (in order in which the lists are sorted)
-def check_lists(py_list, rs_list, pk, table_name, py_db_name, rs_db_name):
-    i=0
-    j=0
-    while i<len(py_list) and j<len(rs_list):
-        py_pk=""
-        rs_pk=""
-        for key in pk:
-            py_pk=py_pk + str(py_list[i][key]) + ","
-            rs_pk=rs_pk + str(rs_list[j][key]) + ","
+    def absorb(self, counts, records, heights=None):
+        self.counts.update(counts)
+        for table_name, table_heights in (heights or {}).items():
+            self.heights.setdefault(table_name, set()).update(table_heights)
+        for record in records:
+            counter_key = (record["table"], record["kind"], record["database"] or record["column"])
+            if self.stored[counter_key] < self.sample_cap:
+                self._store(counter_key, record)
+
+    #inconsistency counts per table and per kind/column of each table
+    def summary(self):
+        tables = {}
+        for (table_name, kind, detail), count in sorted(self.counts.items()):
+            table = tables.setdefault(table_name, {"total": 0, "missing": {}, "inconsistent": {}})
+            table["total"] += count
+            table[kind][detail] = count
+        return {"total": sum(self.counts.values()), "tables": tables}
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        summary = self.summary()
+        for table_name, table in summary["tables"].items():
+            details = ", ".join(f"{kind} {detail}: {count}" for kind in ("missing", "inconsistent")
+                                for detail, count in table[kind].items())
+            logger.info(f"{table_name}: {table['total']} inconsistencies ({details})")
+        logger.info(f"{summary['total']} inconsistencies in total")
+        if self.path is not None:
+            with open(self.path + ".summary.json", "w") as f:
+                json.dump(summary, f, indent=2, default=str)
+        return summary
+
+#passes the inconsistencies of a check_lists with nullable keys on to reporter with their nulls as None
+class NullKeyReporter:
+    def __init__(self, reporter):
+        self.reporter = reporter
+
+    def missing(self, table_name, pk, key, db_name):
+        self.reporter.missing(table_name, pk, reported_key(key), db_name)
+
+    def inconsistent(self, table_name, pk, key, column):
+        self.reporter.inconsistent(table_name, pk, reported_key(key), column)
+
+#to check and log inconsistencies between two iterables of tuple rows returned by psycopg2, consumed lazily
+#pk should be a list of keys which form primary key (in order in which the rows are sorted)
+#py_columns/rs_columns are the column names of the rows of each side, inconsistencies go to reporter
+#excluded are columns of the rows which aren't compared
+#nullable_keys is needed when pk isn't a unique key over not null columns on both sides, see TableSpec: keys with nulls
+#are then ordered nulls last, same as ORDER BY, and rows sharing a key are paired in the order they come in, so
+#duplicate keys show up as missing rows or inconsistencies instead of being skipped
+#returns the number of inconsistencies found
+def check_lists(py_rows, rs_rows, pk, table_name, py_db_name, rs_db_name, py_columns, rs_columns, reporter=None, excluded=(),
+                nullable_keys=False):
+    if reporter is None:
+        reporter = MismatchReporter()
+    py_key, rs_key, py_values, rs_values, shared, py_only = plan_comparison(py_columns, rs_columns, pk, excluded, nullable_keys)
+    if nullable_keys:
+        reporter = NullKeyReporter(reporter)
+    mismatches = 0
+    py_iter = iter(py_rows)
+    rs_iter = iter(rs_rows)
+    py_row = next(py_iter, None)
+    rs_row = next(rs_iter, None)
+    while py_row is not None and rs_row is not None:
+        py_pk = py_key(py_row)
+        rs_pk = rs_key(rs_row)
 
         if py_pk < rs_pk:
-            logger.error(f"Couldn't find data corresponding to {pk}: {py_pk} in {table_name} table of {rs_db_name}")
-            i+=1
+            reporter.missing(table_name, pk, py_pk, rs_db_name)
+            mismatches += 1
+            py_row = next(py_iter, None)
         elif py_pk > rs_pk:
-            logger.error(f"Couldn't find data corresponding to {pk}: {rs_pk} in {table_name} table of {py_db_name}")
-            j+=1
+            reporter.missing(table_name, pk, rs_pk, py_db_name)
+            mismatches += 1
+            rs_row = next(rs_iter, None)
         else:
-            for key in py_list[i]:
-                if key != 'rowid' and key != 'msg_rowid' and py_list[i].get(key) != rs_list[j].get(key):
-                    logger.error(f"Inconsistent {key} at {pk}: {py_pk} in {table_name} table")
-            i+=1
-            j+=1
+            #a single tuple comparison settles identical rows, columns are only walked for rows that differ
+            if py_values(py_row) != rs_values(rs_row):
+                for column, py_index, rs_index in shared:
+                    if py_row[py_index] != rs_row[rs_index]:
+                        reporter.inconsistent(table_name, pk, py_pk, column)
+                        mismatches += 1
+            #columns the rs side doesn't have only match when they are null
+            for column, py_index in py_only:
+                if py_row[py_index] is not None:
+                    reporter.inconsistent(table_name, pk, py_pk, column)
+                    mismatches += 1
+            py_row = next(py_iter, None)
+            rs_row = next(rs_iter, None)
+
+    while py_row is not None:
+        reporter.missing(table_name, pk, py_key(py_row), rs_db_name)
+        mismatches += 1
+        py_row = next(py_iter, None)
+    while rs_row is not None:
+        reporter.missing(table_name, pk, rs_key(rs_row), py_db_name)
+        mismatches += 1
+        rs_row = next(rs_iter, None)
+    return mismatches
+
+#streams the table of spec ordered by pk from both databases and merges the two streams through check_lists
+#selection, if given, limits the comparison to a height range or a sample of the rows, see row_filter
+#with prefetch > 0 both sides run their query and fetch ahead concurrently, see stream_rows
+#scan is the scan method of both sides, see scan_table
+#metrics, if given, gets the per side read stats and the time spent comparing
+def compare_table(py_db, rs_db, spec, batch_size=BATCH_SIZE, selection=None, prefetch=0, reporter=None, metrics=None, scan="keyset"):
+    table_name = spec.name
+    if metrics is None:
+        metrics = RunMetrics()
+    py_stats = metrics.side(table_name, "py")
+    rs_stats = metrics.side(table_name, "rs")
+    if prefetch > 0:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            py_stream = executor.submit(scan_table, py_db, spec, "py", selection, batch_size, prefetch, py_stats, scan)
+            rs_stream = executor.submit(scan_table, rs_db, spec, "rs", selection, batch_size, prefetch, rs_stats, scan)
+            py_columns, py_rows = py_stream.result()
+            rs_columns, rs_rows = rs_stream.result()
+    else:
+        py_columns, py_rows = scan_table(py_db, spec, "py", selection, batch_size, stats=py_stats, scan=scan)
+        rs_columns, rs_rows = scan_table(rs_db, spec, "rs", selection, batch_size, stats=rs_stats, scan=scan)
+
+    #time spent in check_lists minus the time it was blocked waiting for rows of either side
+    waited = py_stats["wait_seconds"] + rs_stats["wait_seconds"]
+    start = time.perf_counter()
+    mismatches = check_lists(py_rows, rs_rows, spec.pk, table_name, py_db._PG_DB, rs_db._PG_DB, py_columns, rs_columns, reporter,
+                             nullable_keys=len(spec.unique_sides) < 2)
+    elapsed = time.perf_counter() - start
+    metrics.side(table_name, "compare")["compare_seconds"] += elapsed - (py_stats["wait_seconds"] + rs_stats["wait_seconds"] - waited)
+    return mismatches
+
+#diffs table_name inside postgres when both indexers are reachable from one database, either as two schemas
+#or with the rs side imported through postgres_fdw (IMPORT FOREIGN SCHEMA), only mismatching keys and
+#the names of the mismatching columns are streamed back, keys and compared columns are those of spec, same as in check_lists
+#returns the number of inconsistencies found
+def server_diff_table(conn, spec, py_schema, rs_schema, py_db_name, rs_db_name, batch_size=BATCH_SIZE, selection=None,
+                      reporter=None, metrics=None):
+    if reporter is None:
+        reporter = MismatchReporter()
+    if metrics is None:
+        metrics = RunMetrics()
+    table_name = spec.name
+    pk = spec.pk
+
+    differs = []
+    for column in spec.columns:
+        #keys are equal by the join condition
+        if column in pk:
+            continue
+        #columns the rs side doesn't have only match when they are null, same as in check_lists
+        if column not in spec.rs_missing:
+            differs.append((column, f"p.{quote(conn, column)} IS DISTINCT FROM r.{quote(conn, column)}"))
+        else:
+            differs.append((column, f"p.{quote(conn, column)} IS NOT NULL"))
+
+    py_where = ""
+    rs_where = ""
+    params = None
+    if selection is not None:
+        py_condition, py_params = row_filter(conn, table_name, pk, selection, py_schema)
+        rs_condition, rs_params = row_filter(conn, table_name, pk, selection, rs_schema)
+        py_where = "WHERE " + py_condition
+        rs_where = "WHERE " + rs_condition
+        params = (*py_params, *rs_params)
+    table = quote(conn, table_name)
+    py_source = f"(SELECT {select_list(conn, spec, 'py')} FROM {quote(conn, py_schema)}.{table} {py_where})"
+    rs_source = f"(SELECT {select_list(conn, spec, 'rs')} FROM {quote(conn, rs_schema)}.{table} {rs_where})"
+
+    keys = [quote(conn, key) for key in pk]
+    #column names are passed as params, like any other value
+    diff_columns = ", ".join(f"CASE WHEN {condition} THEN %s END" for _, condition in differs)
+    query = f"""
+            SELECT p.{keys[0]} IS NULL AS missing_py,
+                   r.{keys[0]} IS NULL AS missing_rs,
+                   {", ".join(f"COALESCE(p.{key}, r.{key}) AS {key}" for key in keys)},
+                   array_remove(ARRAY[{diff_columns or "NULL"}]::text[], NULL) AS diff_columns
+            FROM {py_source} p
+            FULL OUTER JOIN {rs_source} r ON {" AND ".join(f"p.{key} = r.{key}" for key in keys)}
+            WHERE p.{keys[0]} IS NULL OR r.{keys[0]} IS NULL
+                  {"".join(f" OR {condition}" for _, condition in differs)}
+            ORDER BY {", ".join(keys)};
+            """
+    params = (*(column for column, _ in differs), *(params or ())) or None
+
+    mismatches = 0
+    _, rows = stream_rows(conn, query, params, batch_size, stats=metrics.side(table_name, "server"))
+    for missing_py, missing_rs, *key, diff_columns in rows:
+        key = tuple(key)
+        if missing_rs:
+            reporter.missing(table_name, pk, key, rs_db_name)
+            mismatches += 1
+        elif missing_py:
+            reporter.missing(table_name, pk, key, py_db_name)
+            mismatches += 1
+        else:
+            for column in diff_columns:
+                reporter.inconsistent(table_name, pk, key, column)
+                mismatches += 1
+    return mismatches
+
+#returns the [lo, hi) height range covering table_name of both databases, or None if both are empty
+def get_height_bounds(py_cursor, rs_cursor, table_name="block_metadata"):
+    bounds = []
+    for cursor in (py_cursor, rs_cursor):
+        cursor.execute(f"""
+                        SELECT min(height) AS lo, max(height) AS hi
+                        FROM {quote(cursor, table_name)};
+                        """)
+        row = cursor.fetchone()
+        if row['lo'] is not None:
+            bounds.append((row['lo'], row['hi'] + 1))
+    if not bounds:
+        return None
+    return min(lo for lo, _ in bounds), max(hi for _, hi in bounds)
+
+#(row count, digest) of every bucket of width heights in [lo, hi), computed inside postgres from the row text of the
+#compared columns of spec, as selected on side py or rs of db, so that surrogate columns don't count as differences,
+#same as in check_lists, the row text is the same on both servers as the settings it depends on are pinned, see
+#SESSION_SETTINGS
+#the digest is the sum of the first 64 bits of the md5 of every row, which needs neither an order nor a string
+#the size of the bucket, so the aggregate state stays constant however many rows a bucket holds
+#the query is run again on a new connection if it fails, see with_reconnect
+def get_bucket_digests(db, spec, side, lo, hi, width, stats=None):
+    if stats is None:
+        stats = collections.Counter()
+
+    def run(conn):
+        row = ", ".join(select_expressions(conn, spec, side))
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(f"""
+                            SELECT (height - %(lo)s) / %(width)s AS bucket,
+                                   count(*) AS row_count,
+                                   sum(('x' || substr(md5(ROW({row})::text), 1, 16))::bit(64)::bigint::numeric) AS digest
+                            FROM {quote(conn, spec.name)} t
+                            WHERE height >= %(lo)s AND height < %(hi)s
+                            GROUP BY 1;
+                            """, {"lo": lo, "hi": hi, "width": width})
+            return {row['bucket']: (row['row_count'], row['digest']) for row in cursor.fetchall()}
+
+    start = time.perf_counter()
+    digests = with_reconnect(db, run)
+    stats["digest_seconds"] += time.perf_counter() - start
+    stats["digest_queries"] += 1
+    return digests
+
+#compares the table of spec in [lo, hi) by bucket digests, only buckets that disagree are split further
+#and only leaf ranges of at most leaf_size heights which disagree are pulled into check_lists
+def checksum_compare_table(py_db, rs_db, spec, lo, hi, leaf_size, fanout, batch_size=BATCH_SIZE, prefetch=0,
+                           reporter=None, metrics=None, scan="keyset"):
+    if metrics is None:
+        metrics = RunMetrics()
+    if hi - lo <= leaf_size:
+        return compare_table(py_db, rs_db, spec, batch_size, (lo, hi), prefetch, reporter, metrics, scan)
+    table_name = spec.name
+    mismatches = 0
+    width = max(-(-(hi - lo) // fanout), 1)
+    py_digests = get_bucket_digests(py_db, spec, "py", lo, hi, width, metrics.side(table_name, "py"))
+    rs_digests = get_bucket_digests(rs_db, spec, "rs", lo, hi, width, metrics.side(table_name, "rs"))
+    for bucket in sorted(py_digests.keys() | rs_digests.keys()):
+        if py_digests.get(bucket) != rs_digests.get(bucket):
+            bucket_lo = lo + bucket * width
+            bucket_hi = min(bucket_lo + width, hi)
+            logger.debug(f"Digest mismatch in {table_name} table for heights [{bucket_lo}, {bucket_hi})")
+            mismatches += checksum_compare_table(py_db, rs_db, spec, bucket_lo, bucket_hi, leaf_size, fanout,
+                                                 batch_size, prefetch, reporter, metrics, scan)
+    return mismatches
+
+#splits the height range of table_name into at most shards contiguous [lo, hi) ranges which together cover
+#every row of both databases, rows at a boundary belong to exactly one shard since the ranges are half-open
+#uniform splits the min/max range evenly, percentile balances the row count of the shards on the py side
+#height_range, if given, is split instead of the whole height range of the table
+def get_shard_ranges(py_cursor, rs_cursor, table_name, shards, split="uniform", height_range=None):
+    height_bounds = height_range or get_height_bounds(py_cursor, rs_cursor, table_name)
+    if height_bounds is None:
+        return []
+    lo, hi = height_bounds
+    if split == "percentile":
+        py_cursor.execute(f"""
+                        SELECT percentile_disc(%s) WITHIN GROUP (ORDER BY height) AS cuts
+                        FROM {quote(py_cursor, table_name)}
+                        WHERE height >= %s AND height < %s;
+                        """, ([k / shards for k in range(1, shards)], lo, hi))
+        cuts = py_cursor.fetchone()['cuts'] or []
+    else:
+        step = -(-(hi - lo) // shards)
+        cuts = [lo + k * step for k in range(1, shards)]
+    edges = sorted({lo, hi, *(cut for cut in cuts if lo < cut < hi)})
+    return list(zip(edges, edges[1:]))
+
+#Wilson score interval of k inconsistent out of n sampled rows, z = 1.96 for 95% confidence
+def wilson_interval(k, n, z=1.96):
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(center - margin, 0.0), min(center + margin, 1.0)
+
+#estimated mismatch rates of a sampling run, per table and overall, with their 95% confidence intervals
+#the rate is one over the units drawn at random: heights for the tables of height_tables, as the rows of a height are
+#correlated, so the rate is the fraction of the sampled heights with at least one inconsistency (mismatch_heights are
+#those heights per table, see MismatchReporter), tables whose key has no height count every inconsistency as a height
+#of its own, which errs on the high side, the other tables sample keys independently, their rate is the fraction of
+#inconsistent rows, counting a row once per inconsistent column, which errs on the high side as well
+#all is the rate over heights of the height sampled tables together
+def estimate_mismatch_rates(metrics, mismatches, mismatch_heights, heights, height_tables):
+    def estimate(unit, k, n):
+        k = min(k, n)
+        low, high = wilson_interval(k, n)
+        return {"unit": unit, "sampled": n, "inconsistent": k, "rate": k / n if n else None, "low": low, "high": high}
+
+    estimates = {}
+    all_heights = set()
+    unattributed = 0
+    for table_name, sides in metrics.tables.items():
+        total = mismatches["tables"].get(table_name, {}).get("total", 0)
+        if table_name in height_tables:
+            if table_name in mismatch_heights:
+                table_heights = mismatch_heights[table_name]
+                all_heights |= table_heights
+                estimates[table_name] = estimate("heights", len(table_heights), len(heights))
+            else:
+                unattributed += total
+                estimates[table_name] = estimate("heights", total, len(heights))
+        else:
+            n = max(sides.get("py", {}).get("rows", 0), sides.get("rs", {}).get("rows", 0))
+            estimates[table_name] = estimate("rows", total, n)
+    estimates["all"] = estimate("heights", len(all_heights) + unattributed, len(heights))
+    return estimates
+
+#highest block height present in block_metadata of both databases, or None if either is empty
+def get_common_height(py_cursor, rs_cursor):
+    heights = []
+    for cursor in (py_cursor, rs_cursor):
+        cursor.execute("""
+                        SELECT max(height) AS height
+                        FROM block_metadata;
+                        """)
+        heights.append(cursor.fetchone()['height'])
+    if None in heights:
+        return None
+    return min(heights)
+
+#incremental mode state: last fully validated height per table and
+#last_update_height of every module whose state tables were validated
+def load_state(path):
+    if not os.path.exists(path):
+        return {"tables": {}, "module_state": {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_state(path, state):
+    write_atomically(path, json.dumps(state, indent=2, sort_keys=True))
+
+#connections and options used by validate_table, set once per process
+_context = {}
+
+def set_context(ingespy, ingesrs, registry, args, reporter, metrics):
+    _context["ingespy"] = ingespy
+    _context["ingesrs"] = ingesrs
+    _context["registry"] = registry
+    _context["args"] = args
+    _context["reporter"] = reporter
+    _context["metrics"] = metrics
+
+def export_snapshot(cursor):
+    cursor.execute("SELECT pg_export_snapshot() AS snapshot;")
+    return cursor.fetchone()['snapshot']
+
+#pool initializer: opens this worker's own pair of connections on the snapshots exported by main()
+#so that every worker sees both databases at the same point in time
+def init_worker(py_connect_args, rs_connect_args, py_snapshot, rs_snapshot, registry, args):
+    ingespy = IndexerDatabase(**py_connect_args)
+    ingesrs = IndexerDatabase(**rs_connect_args)
+    ingespy.begin_snapshot_session(py_snapshot)
+    ingesrs.begin_snapshot_session(rs_snapshot)
+    #samples are handed to the reporter of main() after every task, see validate_task_in_worker
+    set_context(ingespy, ingesrs, registry, args, MismatchReporter(sample_cap=args.sample_cap, log_samples=False,
+                                                                    track_heights=args.sample_heights > 0), RunMetrics())
+
+#validates one table, or the selection of its rows (a [lo, hi) height range shard or a sample), with the connections
+#of the current process, by_height marks tables having a height column, those are compared through bucket digests in checksum mode
+#returns the number of inconsistencies found
+def validate_table(table_name, by_height=False, selection=None):
+    ingespy = _context["ingespy"]
+    ingesrs = _context["ingesrs"]
+    spec = _context["registry"][table_name]
+    args = _context["args"]
+    reporter = _context["reporter"]
+    metrics = _context["metrics"]
+
+    if selection is None:
+        logger.info(f"Validating {table_name} table")
+    else:
+        logger.info(f"Validating {table_name} table for {describe_selection(selection)}")
+    if args.server_diff:
+        mismatches = server_diff_table(ingespy.conn, spec, args.py_schema, args.rs_schema, ingespy._PG_DB, ingesrs._PG_DB,
+                                       args.batch_size, selection, reporter, metrics)
+    elif not (args.checksum and by_height):
+        mismatches = compare_table(ingespy, ingesrs, spec, args.batch_size, selection, args.prefetch, reporter, metrics, args.scan)
+    else:
+        height_bounds = selection
+        if height_bounds is None:
+            with ingespy.conn.cursor(cursor_factory=RealDictCursor) as py_cursor, ingesrs.conn.cursor(cursor_factory=RealDictCursor) as rs_cursor:
+                height_bounds = get_height_bounds(py_cursor, rs_cursor, table_name)
+        mismatches = 0
+        if height_bounds is not None:
+            mismatches = checksum_compare_table(ingespy, ingesrs, spec, *height_bounds, args.leaf_size, args.fanout,
+                                                args.batch_size, args.prefetch, reporter, metrics, args.scan)
+    metrics.record_memory(table_name)
+    return mismatches
 
-    while i<len(py_list):
-        logger.error(f"Couldn't find data corresponding to {pk}: {py_pk} in {table_name} table of {rs_db_name}")
-        i+=1
-    while j<len(rs_list):
-        logger.error(f"Couldn't find data corresponding to {pk}: {rs_pk} in {table_name} table of {py_db_name}")
-        j+=1
+#pool task: validates a validate_table task and returns what the worker's reporter and metrics collected
+def validate_task_in_worker(task):
+    validate_table(*task)
+    return _context["reporter"].take(), _context["metrics"].take()
+
+#(table_name, by_height) of the tables holding chain data, the ones validated block by block in follow mode
+#those are the tables of registry with a height column, or restricted to heights through HEIGHT_FILTERS, e.g.
+#msg_fact_table: one ordered scan per side instead of a query per transaction, messages of a transaction present
+#on only one side show up as missing messages in the other database
+#state_tables are rewritten in place, they have their own schedule even if they have a height column
+def chain_tables(registry, state_tables=()):
+    return [(spec.name, spec.by_height) for spec in registry.values()
+            if (spec.by_height or spec.name in HEIGHT_FILTERS) and spec.name not in state_tables]
+
+#prepares the per block query of every table of specs on conn of side py or rs, planned once and executed
+#with the height as only parameter
+def prepare_block_queries(conn, specs, side):
+    with conn.cursor() as cursor:
+        cursor.execute("PREPARE follow_max_height AS SELECT max(height) FROM block_metadata;")
+        for spec in specs:
+            condition = HEIGHT_FILTERS.get(spec.name, "{condition}").format(schema="", condition="height = $1")
+            cursor.execute(f"""
+                            PREPARE {quote(cursor, "follow_" + spec.name)}(bigint) AS
+                            SELECT {select_list(cursor, spec, side)}
+                            FROM {quote(cursor, spec.name)}
+                            WHERE {condition}
+                            ORDER BY {key_order(cursor, spec)};
+                            """)
+
+def fetch_block(cursor, table_name, height):
+    cursor.execute(f"EXECUTE {quote(cursor, 'follow_' + table_name)}(%s);", (height,))
+    return [column[0] for column in cursor.description], cursor.fetchall()
+
+def get_max_height(cursor):
+    cursor.execute("EXECUTE follow_max_height;")
+    return cursor.fetchone()[0]
+
+#validates the rows of every table of specs at height, the rows read are added to metrics
+#returns the number of inconsistencies found per table, tables without any are left out
+def validate_block(py_cursor, rs_cursor, specs, height, py_db_name, rs_db_name, reporter, metrics):
+    mismatches = collections.Counter()
+    for spec in specs:
+        py_columns, py_rows = fetch_block(py_cursor, spec.name, height)
+        rs_columns, rs_rows = fetch_block(rs_cursor, spec.name, height)
+        metrics.side(spec.name, "py")["rows"] += len(py_rows)
+        metrics.side(spec.name, "rs")["rows"] += len(rs_rows)
+        count = check_lists(py_rows, rs_rows, spec.pk, spec.name, py_db_name, rs_db_name, py_columns, rs_columns, reporter,
+                            nullable_keys=len(spec.unique_sides) < 2)
+        if count:
+            mismatches[spec.name] += count
+    return mismatches
+
+#logs the inconsistency counts since following started and exports them with metrics, so that divergence stays visible
+#once the samples of a table and kind/column have reached sample_cap
+def report_progress(reporter, metrics, args, next_height, duration):
+    summary = reporter.summary()
+    tables = ", ".join(f"{table_name}: {table['total']}" for table_name, table in summary["tables"].items())
+    logger.info(f"Following at height {next_height}, {summary['total']} inconsistencies since start" + (f" ({tables})" if tables else ""))
+    metrics.export(args.metrics_json, args.metrics_prom, duration, summary)
+
+#blocks until one of the connections gets a notification on the listened channel, or until timeout
+def wait_for_notify(conns, timeout):
+    select.select(conns, [], [], timeout)
+    for conn in conns:
+        conn.poll()
+        conn.notifies.clear()
+
+#autocommit so each poll sees the latest commits, prepared statements so a block costs a few round trips,
+#set up again on the new connection after a reconnect
+def start_following(db, specs, side, args):
+    db.conn.autocommit = True
+    prepare_block_queries(db.conn, specs, side)
+    if args.notify_channel:
+        with db.conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {quote(cursor, args.notify_channel)};")
+
+#validates every new height of the chain tables as soon as it is committed on both sides, until interrupted
+#a dropped connection or a statement timeout reconnects both sides and validates the interrupted height again from its
+#first table, up to db.retries times in a row before giving up, the inconsistencies of a height only reach reporter
+#once all of its tables are validated, so that a height validated again doesn't count them twice
+#specs are the TableSpecs of the chain tables, see chain_tables
+#heights with inconsistencies are logged as they are validated, and a running summary every summary_interval seconds
+def follow(ingespy, ingesrs, specs, args, reporter):
+    for db, side in ((ingespy, "py"), (ingesrs, "rs")):
+        start_following(db, specs, side, args)
+
+    metrics = RunMetrics()
+    started = time.perf_counter()
+    last_report = started
+    next_height = args.follow_from
+    attempt = 0
+    try:
+        while True:
+            try:
+                with ingespy.conn.cursor() as py_cursor, ingesrs.conn.cursor() as rs_cursor:
+                    py_height = get_max_height(py_cursor)
+                    rs_height = get_max_height(rs_cursor)
+                    if py_height is not None and rs_height is not None:
+                        common_height = min(py_height, rs_height)
+                        if next_height is None:
+                            next_height = common_height + 1
+                            logger.info(f"Following from height {next_height}")
+                        while next_height <= common_height:
+                            start = time.perf_counter()
+                            block_reporter = MismatchReporter(sample_cap=reporter.sample_cap, log_samples=False,
+                                                              track_heights=reporter.track_heights)
+                            mismatches = validate_block(py_cursor, rs_cursor, specs, next_height, ingespy._PG_DB, ingesrs._PG_DB,
+                                                        block_reporter, metrics)
+                            reporter.absorb(*block_reporter.take())
+                            reporter.flush()
+                            attempt = 0
+                            if mismatches:
+                                logger.warning(f"{sum(mismatches.values())} inconsistencies at height {next_height} ("
+                                               + ", ".join(f"{table_name}: {count}" for table_name, count in mismatches.items()) + ")")
+                            logger.debug(f"Validated height {next_height} in {(time.perf_counter() - start) * 1000:.1f} ms")
+                            next_height += 1
+            except RETRY_ERRORS as e:
+                attempt += 1
+                if attempt > ingespy.retries:
+                    logger.error(f"Giving up following at height {next_height} after {ingespy.retries} retries: {e}")
+                    raise
+                logger.warning(f"Lost a connection while following at height {next_height}, reconnecting "
+                               f"(retry {attempt}/{ingespy.retries}): {e}")
+                for db, side in ((ingespy, "py"), (ingesrs, "rs")):
+                    db.reconnect()
+                    start_following(db, specs, side, args)
+                continue
+            if time.perf_counter() - last_report >= args.summary_interval:
+                last_report = time.perf_counter()
+                report_progress(reporter, metrics, args, next_height, last_report - started)
+            if args.notify_channel:
+                wait_for_notify([ingespy.conn, ingesrs.conn], args.poll_interval)
+            else:
+                time.sleep(args.poll_interval)
+    except KeyboardInterrupt:
+        logger.info(f"Stopped following, next height would have been {next_height}")
+    finally:
+        metrics.export(args.metrics_json, args.metrics_prom, time.perf_counter() - started, reporter.close())
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Validate ingest-py and ingest-rs indexer databases against each other")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="rows fetched per round trip from each server-side cursor")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="batches fetched ahead per side on a background thread while the current batch is compared, 0 disables")
+    parser.add_argument("--scan", choices=["keyset", "cursor"], default="keyset",
+                        help="page through tables by primary key, resuming after a dropped connection, "
+                             "or run one query per table on a server-side cursor, which keyset falls back to for keys "
+                             "without a unique index or an index in their sort order")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="reconnect attempts after a failed connection or query before giving up")
+    parser.add_argument("--retry-backoff", type=float, default=1.0,
+                        help="seconds to wait before the first reconnect attempt, doubled after every failed attempt")
+    parser.add_argument("--registry-file",
+                        help="file caching the tables, keys and compared columns introspected from both databases, "
+                             "rebuilt whenever the catalog of either database changes, by default they are introspected every run")
+    parser.add_argument("--refresh-registry", action="store_true",
+                        help="introspect both databases again instead of using --registry-file, e.g. after a migration")
+    parser.add_argument("--exclude-column", action="append", default=[],
+                        help="column never compared, in addition to the sequence or identity backed ones, can be repeated")
+    parser.add_argument("--key", action="append", default=[], metavar="TABLE=COLUMN,...",
+                        help="columns table is merged by, instead of its catalog or known key, can be repeated, "
+                             "without a unique index on them rows sharing a key are reported as mismatches")
+    parser.add_argument("--skip-table", action="append", default=[], help="table never validated, can be repeated")
+    parser.add_argument("--checksum", action="store_true",
+                        help="compare height-bucket digests first and only fetch rows of buckets that differ")
+    parser.add_argument("--leaf-size", type=int, default=1000,
+                        help="checksum mode: height range small enough to be compared row by row")
+    parser.add_argument("--fanout", type=int, default=16,
+                        help="checksum mode: number of buckets a differing height range is split into")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes validating tables concurrently, each with its own connections")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split every height-keyed table into this many height ranges validated as separate tasks")
+    parser.add_argument("--shard-split", choices=["uniform", "percentile"], default="uniform",
+                        help="split the min/max height range evenly, or by row count percentiles of the py side")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only validate heights above the checkpoints recorded in --state-file by the previous run")
+    parser.add_argument("--state-file", default="validator-state.json",
+                        help="incremental mode: file holding the per-table checkpoints")
+    parser.add_argument("--overlap", type=int, default=100,
+                        help="incremental mode: heights below the checkpoint validated again in case of reorgs")
+    parser.add_argument("--server-diff", action="store_true",
+                        help="diff each table inside postgres with a FULL OUTER JOIN of --py-schema and --rs-schema "
+                             "on the py connection, for indexers sharing a cluster (two schemas or postgres_fdw)")
+    parser.add_argument("--py-schema", help="schema holding the ingest-py tables, used as search_path of the py connection")
+    parser.add_argument("--rs-schema", help="schema holding the ingest-rs tables (or their postgres_fdw foreign tables), "
+                                            "used as search_path of the rs connection")
+    parser.add_argument("--report", help="write sampled inconsistencies to this file, and a summary to <report>.summary.json, "
+                                          "instead of logging them")
+    parser.add_argument("--report-format", choices=["jsonl", "csv"], default="jsonl", help="format of --report")
+    parser.add_argument("--sample-cap", type=int, default=1000,
+                        help="inconsistencies kept as samples per table and kind/column, all of them are counted")
+    parser.add_argument("--sample-heights", type=int, default=0,
+                        help="sampling mode: validate only this many randomly chosen heights of the height-keyed tables")
+    parser.add_argument("--sample-fraction", type=float, default=0.01,
+                        help="sampling mode: fraction of the keys of the other tables validated, chosen by a salted key hash")
+    parser.add_argument("--seed", type=int, default=0, help="sampling mode: seed of the height and key selection")
+    parser.add_argument("--follow", action="store_true",
+                        help="run continuously, validating the chain tables of every new height once both indexers committed it")
+    parser.add_argument("--follow-from", type=int,
+                        help="follow mode: first height to validate, defaults to the first height after the current common height")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="follow mode: seconds between polls of block_metadata, or the longest wait for a notification")
+    parser.add_argument("--notify-channel",
+                        help="follow mode: LISTEN on this channel on both databases and poll as soon as a notification arrives")
+    parser.add_argument("--summary-interval", type=float, default=60.0,
+                        help="follow mode: seconds between running inconsistency summaries in the log and exports of "
+                             "--metrics-json/--metrics-prom")
+    parser.add_argument("--metrics-json", help="write per table and side timings, volumes and inconsistency counts as json")
+    parser.add_argument("--metrics-prom", help="write the same metrics as a prometheus textfile, e.g. for the node_exporter textfile collector")
+    parser.add_argument("--profile", action="store_true",
+                        help="run main() under cProfile and tracemalloc, stats go to --profile-output and the log")
+    parser.add_argument("--profile-output", default="validator.prof", help="profile mode: file the cProfile stats are dumped to")
+    args = parser.parse_args()
+    keys = {}
+    for key in args.key:
+        table_name, _, columns = key.partition("=")
+        if not table_name or not columns:
+            parser.error(f"--key {key}: expected TABLE=COLUMN,...")
+        keys[table_name] = columns.split(",")
+    args.key = keys
+    if args.server_diff and not (args.py_schema and args.rs_schema):
+        parser.error("--server-diff needs --py-schema and --rs-schema")
+    if args.sample_heights and (args.checksum or args.incremental or args.shards > 1 or args.server_diff):
+        parser.error("--sample-heights can't be combined with --checksum, --incremental, --shards or --server-diff")
+    return args
+
+#runs the validation under cProfile and tracemalloc, worker processes are not profiled
+def run_profiled(args):
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run, args)
+    finally:
+        profiler.dump_stats(args.profile_output)
+        _, peak = tracemalloc.get_traced_memory()
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]:
+            logger.info(f"tracemalloc: {stat}")
+        logger.info(f"tracemalloc peak: {peak / 2 ** 20:.1f} MiB, cProfile stats written to {args.profile_output}")
+        tracemalloc.stop()
 
 def main():
-    ingespy = IndexerDatabase(db_name='indexerdb', user='postgres', password='postgres', host='localhost', port='5432')
-    ingesrs = IndexerDatabase(db_name='indexerdb', user='postgres', password='postgres', host='localhost', port='5432')
+    args = parse_args()
+    if args.profile:
+        run_profiled(args)
+    else:
+        run(args)
+
+def run(args):
+    ingespy = IndexerDatabase(db_name='indexerdb', user='postgres', password='postgres', host='localhost', port='5432', schema=args.py_schema,
+                              retries=args.retries, backoff=args.retry_backoff)
+    ingesrs = IndexerDatabase(db_name='indexerdb', user='postgres', password='postgres', host='localhost', port='5432', schema=args.rs_schema,
+                              retries=args.retries, backoff=args.retry_backoff)
 
     logger.info("Starting validator script!")
 
-    with ingespy.conn as py_conn, ingesrs.conn as rs_conn:
-        with py_conn.cursor(cursor_factory=RealDictCursor) as py_cursor, rs_conn.cursor(cursor_factory=RealDictCursor) as rs_cursor:
-            py_cursor.execute("""
-                                SELECT *
-                                FROM block_metadata
-                                ORDER BY height;
-                                """)
-            py_blocks = py_cursor.fetchall()
-            rs_cursor.execute("""
-                                SELECT *
-                                FROM block_metadata
-                                ORDER BY height;
-                                """)
-            rs_blocks = rs_cursor.fetchall()
-
-            check_lists(py_blocks, rs_blocks, ["height"], "block_metadata", ingespy._PG_DB, ingesrs._PG_DB)
-
-            # i=0
-            # j=0
-            # while i<len(py_blocks) and j<len(rs_blocks):
-            #     if py_blocks[i]['height'] < rs_blocks[j]['height']:
-            #         logger.error(f"Couldn't find block of height {py_blocks[i]['height']} in block_metadata table of {ingesrs._PG_DB}")
-            #         i+=1
-            #     elif py_blocks[i]['height'] > rs_blocks[j]['height']:
-            #         logger.error(f"Couldn't find block of height {rs_blocks[j]['height']} in block_metadata table of {ingespy._PG_DB}")
-            #         j+=1
-            #     else:
-            #         for key in py_blocks[i]:
-            #             if key != 'rowid' and py_blocks[i].get(key) != rs_blocks[j].get(key):
-            #                 logger.error(f"Inconsistent {key} at block height {py_blocks[i]['height']} in block_metadata")
-            #         i+=1
-            #         j+=1
-
-            # while i<len(py_blocks):
-            #     logger.error(f"Couldn't find block of height {py_blocks[i]['height']} in block_metadata table of {ingesrs._PG_DB}")
-            #     i+=1
-            # while j<len(rs_blocks):
-            #     logger.error(f"Couldn't find block of height {rs_blocks[j]['height']} in block_metadata table of {ingespy._PG_DB}")
-            #     j+=1
-
-            py_cursor.execute("""
-                                SELECT *
-                                FROM txn_fact_table
-                                ORDER BY height, tx_index;
-                                """)
-            py_txns = py_cursor.fetchall()
-            rs_cursor.execute("""
-                                SELECT *
-                                FROM txn_fact_table
-                                ORDER BY height, tx_index;
-                                """)
-            rs_txns = rs_cursor.fetchall()
-
-            check_lists(py_txns, rs_txns, ["height", "tx_index"], "txn_fact_table", ingespy._PG_DB, ingesrs._PG_DB)
-
-            # i=0
-            # j=0
-            # while i<len(py_txns) and j<len(rs_txns):
-            #     if (py_txns[i]['height'] < rs_txns[j]['height']) or (py_txns[i]['height'] == rs_txns[j]['height'] and py_txns[i]['tx_index'] < rs_txns[j]['tx_index']):
-            #         logger.error(f"Couldn't find transaction with block height {py_txns[i]['height']} with tx_index {py_txns[i]['tx_index']} in txn_fact_table of {ingesrs._PG_DB}")
-            #         i+=1
-            #     elif (py_txns[i]['height'] > rs_txns[j]['height']) or (py_txns[i]['height'] == rs_txns[j]['height'] and py_txns[i]['tx_index'] > rs_txns[j]['tx_index']):
-            #         logger.error(f"Couldn't find transaction with block height {rs_txns[j]['height']} with tx_index {rs_txns[j]['tx_index']} in txn_fact_table of {ingespy._PG_DB}")
-            #         j+=1
-            #     else:
-            #         for key in py_txns[i]:
-            #             if key != 'rowid' and py_txns[i].get(key) != rs_txns[j].get(key):
-            #                 logger.error(f"Inconsistent {key} at block height {py_txns[i]['height']} and tx_index {py_txns[j]['tx_index']} in txn_fact_table")
-            #         i+=1
-            #         j+=1
-            
-            # while i<len(py_txns):
-            #     logger.error(f"Couldn't find transaction with block height {py_txns[i]['height']} and tx_index {py_txns[i]['tx_index']} in txn_fact_table of {ingesrs._PG_DB}")
-            #     i+=1
-            # while j<len(rs_txns):
-            #     logger.error(f"Couldn't find transaction with block height {rs_txns[j]['height']} and tx_index {rs_txns[j]['tx_index']} in txn_fact_table of {ingespy._PG_DB}")
-            #     j+=1
-            
-            for tx in py_txns:
-                py_cursor.execute("""
-                                    SELECT *
-                                    FROM msg_fact_table
-                                    WHERE tx_hash = %s
-                                    ORDER BY msg_index;
-                                    """, (tx["tx_hash"],))
-                py_msgs = py_cursor.fetchall()
-                rs_cursor.execute("""
-                                    SELECT *
-                                    FROM msg_fact_table
-                                    WHERE tx_hash = %s
-                                    ORDER BY msg_index;
-                                    """, (tx["tx_hash"],))
-                rs_msgs = rs_cursor.fetchall()
-
-                check_lists(py_msgs, rs_msgs, ["msg_index"], "msg_fact_table", ingespy._PG_DB, ingesrs._PG_DB)
-
-                # i=0
-                # j=0
-                # while i<len(py_msgs) and j<len(rs_msgs):
-                #     if py_msgs[i]['msg_index'] < rs_msgs[j]['msg_index']:
-                #         logger.error(f"Couldn't find message with tx_hash {py_msgs[i]['tx_hash']} and msg_index {py_msgs[i]['msg_index']} in msg_fact_table of {ingesrs._PG_DB}")
-                #         i+=1
-                #     elif py_msgs[i]['msg_index'] > rs_msgs[j]['msg_index']:
-                #         logger.error(f"Couldn't find message with tx_hash {rs_msgs[j]['tx_hash']} and msg_index {rs_msgs[j]['msg_index']} in msg_fact_table of {ingespy._PG_DB}")
-                #         j+=1
-                #     else:
-                #         for key in py_msgs[i]:
-                #             if key != 'msg_rowid' and py_msgs[i].get(key) != rs_msgs[j].get(key):
-                #                 logger.error(f"Inconsistent {key} for tx_hash {py_msgs[i]['tx_hash']} and msg_index{py_msgs[i]['msg_index']} in msg_fact_table")
-                #         i+=1
-                #         j+=1
-
-                # while i<len(py_msgs):
-                #     logger.error(f"Couldn't find message with tx_hash {py_msgs[i]['tx_hash']} and msg_index {py_msgs[i]['msg_index']} in msg_fact_table of {ingesrs._PG_DB}")
-                #     i+=1
-                # while j<len(rs_msgs):
-                #     logger.error(f"Couldn't find message with tx_hash {rs_msgs[j]['tx_hash']} and msg_index {rs_msgs[j]['msg_index']} in msg_fact_table of {ingespy._PG_DB}")
-                #     j+=1
-                
-            for msg_type in tx_msg_type:
-                py_cursor.execute(f"""
-                                SELECT *
-                                FROM {msg_type}
-                                ORDER BY height, hash, index;
-                                """)
-                py_msg_body = py_cursor.fetchall()
-                rs_cursor.execute(f"""
-                                    SELECT *
-                                    FROM {msg_type}
-                                    ORDER BY height, hash, index;
-                                    """)
-                rs_msg_body = rs_cursor.fetchall()
-
-                check_lists(py_msg_body, rs_msg_body, ["height", "hash", "index"], msg_type, ingespy._PG_DB, ingesrs._PG_DB)
-
-                # i=0
-                # j=0
-                # while i<len(py_msg_body) and j<len(rs_msg_body):
-                #     if (py_msg_body[i]['height'] < rs_msg_body[j]['height']) or \
-                #         (py_msg_body[i]['height'] == rs_msg_body[j]['height'] and py_msg_body[i]['hash'] < rs_msg_body[j]['hash']) or \
-                #         (py_msg_body[i]['height'] == rs_msg_body[j]['height'] and py_msg_body[i]['hash'] == rs_msg_body[j]['hash'] and py_msg_body[i]['index'] < rs_msg_body[j]['index']): 
-                #         logger.error(f"Couldn't find message entry with block height {py_msg_body[i]['height']}, tx_hash {py_msg_body[i]['hash']} and msg_index {py_msg_body[i]['index']} in {msg_type} table of {ingesrs._PG_DB}")
-                #         i+=1
-
-                #     elif (py_msg_body[i]['height'] > rs_msg_body[j]['height']) or \
-                #         (py_msg_body[i]['height'] == rs_msg_body[j]['height'] and py_msg_body[i]['hash'] > rs_msg_body[j]['hash']) or \
-                #         (py_msg_body[i]['height'] == rs_msg_body[j]['height'] and py_msg_body[i]['hash'] == rs_msg_body[j]['hash'] and py_msg_body[i]['index'] > rs_msg_body[j]['index']):
-                #         logger.error(f"Couldn't find message entry with block height {rs_msg_body[j]['height']}, tx_hash {rs_msg_body[j]['hash']} and msg_index {rs_msg_body[j]['index']} in {msg_type} table of {ingespy._PG_DB}")
-                #         j+=1
-
-                #     else:
-                #         for key in py_msg_body[i]:
-                #             if key != 'rowid' and py_msg_body[i].get(key) != rs_msg_body[j].get(key):
-                #                 logger.error(f"Inconsistent {key} at block height {py_msg_body[i]['height']}, tx_hash {py_msg_body[i]['hash']} and tx_index {py_txns[j]['index']} in {msg_type} table")
-                #         i+=1
-                #         j+=1
-
-                # while i<len(py_msg_body):
-                #     logger.error(f"Couldn't find message entry with block height {py_msg_body[i]['height']}, tx_hash {py_msg_body[i]['hash']} and msg_index {py_msg_body[i]['index']} in {msg_type} table of {ingesrs._PG_DB}")
-                #     i+=1
-                # while j<len(rs_msg_body):
-                #     logger.error(f"Couldn't find message entry with block height {rs_msg_body[j]['height']}, tx_hash {rs_msg_body[j]['hash']} and msg_index {rs_msg_body[j]['index']} in {msg_type} table of {ingespy._PG_DB}")
-                #     j+=1
-
-
-
-
-            #for checking state tables of different modules at the latest height
-            py_cursor.execute("""
-                            SELECT *
-                            FROM module_state
-                            ORDER BY module_name;
-                            """)
-            py_module_state = py_cursor.fetchall()
-            rs_cursor.execute("""
-                            SELECT *
-                            FROM module_state
-                            ORDER BY module_name;
-                            """)
-            rs_module_state = rs_cursor.fetchall()
+    with ingespy.conn.cursor(cursor_factory=RealDictCursor) as py_cursor, ingesrs.conn.cursor(cursor_factory=RealDictCursor) as rs_cursor:
+        registry = load_registry(py_cursor, rs_cursor, ingespy, ingesrs, args.registry_file, args.refresh_registry, args.exclude_column,
+                                 args.key, args.skip_table)
+        state_tables = get_state_tables(py_cursor) | get_state_tables(rs_cursor)
+    #the catalog queries ran ahead of the session the validation runs in, which is set up below
+    ingespy.conn.rollback()
+    ingesrs.conn.rollback()
 
-            i=0
-            j=0
-            
-            while i<len(py_module_state) and j<len(rs_module_state):
-                if py_module_state[i]['module_name'] == rs_module_state[j]['module_name']:
-                    if py_module_state[i]['last_update_height'] == rs_module_state[j]['last_update_height']:
-                        if py_module_state[i]['module_name']=="balances":
-                            py_cursor.execute("""
-                                            SELECT *
-                                            FROM balances
-                                            ORDER BY address, denom;
-                                            """)
-                            py_balances = py_cursor.fetchall()
-                            rs_cursor.execute("""
-                                            SELECT *
-                                            FROM balances
-                                            ORDER BY address, denom;
-                                            """)
-                            rs_balances = rs_cursor.fetchall()
-                            check_lists(py_balances, rs_balances, ["address", "denom"], "balances", ingespy._PG_DB, ingesrs._PG_DB)
-                        elif py_module_state[i]['module_name']=="denom_metadata":
-                            py_cursor.execute("""
-                                            SELECT *
-                                            FROM denom_metatdata
-                                            ORDER BY denom, decimal;
-                                            """)
-                            py_denom_metadata = py_cursor.fetchall()
-                            rs_cursor.execute("""
-                                            SELECT *
-                                            FROM denom_metatdata
-                                            ORDER BY denom;
-                                            """)
-                            rs_denom_metadata = rs_cursor.fetchall()
-                            check_lists(py_denom_metadata, rs_denom_metadata, ["denom"], "denom_metadata", ingespy._PG_DB, ingesrs._PG_DB)
-                        elif py_module_state[i]['module_name']=="staked":
-                            py_cursor.execute("""
-                                            SELECT *
-                                            FROM staked
-                                            ORDER BY address, validator_address;
-                                            """)
-                            py_staked = py_cursor.fetchall()
-                            rs_cursor.execute("""
-                                            SELECT *
-                                            FROM staked
-                                            ORDER BY address, validator_address;
-                                            """)
-                            rs_staked = rs_cursor.fetchall()
-                            check_lists(py_staked, rs_staked, ["address", "validator_address"], "staked", ingespy._PG_DB, ingesrs._PG_DB)
-                        elif py_module_state[i]['module_name']=="unstaking":
-                            py_cursor.execute("""
-                                            SELECT *
-                                            FROM unstaking
-                                            ORDER BY address, validator_address;
-                                            """)
-                            py_unstaking = py_cursor.fetchall()
-                            rs_cursor.execute("""
-                                            SELECT *
-                                            FROM unstaking
-                                            ORDER BY address, validator_address;
-                                            """)
-                            rs_unstaking = rs_cursor.fetchall()
-                            check_lists(py_unstaking, rs_unstaking, ["address", "validator_address"], "unstaking", ingespy._PG_DB, ingesrs._PG_DB)
-                        elif py_module_state[i]['module_name']=="validator_metadata":
-                            py_cursor.execute("""
-                                            SELECT *
-                                            FROM validator_metadata
-                                            ORDER BY validator_address;
-                                            """)
-                            py_validator_metadata = py_cursor.fetchall()
-                            rs_cursor.execute("""
-                                            SELECT *
-                                            FROM validator_metadata
-                                            ORDER BY validator_address;
-                                            """)
-                            rs_validator_metadata = rs_cursor.fetchall()
-                            check_lists(py_validator_metadata, rs_validator_metadata, ["validator_address"], "validator_metadata", ingespy._PG_DB, ingesrs._PG_DB)
-                    else:
-                        logger.error(f"Inconsistent last_update_height for {py_module_state[i]['module_name']}: {ingespy._PG_DB}: {py_module_state[i]['last_update_height']}, {ingesrs._PG_DB}: {rs_module_state[j]['last_update_height']}")
-                    i+=1
-                    j+=1
+    if args.follow:
+        specs = [registry[table_name] for table_name, _ in chain_tables(registry, state_tables)]
+        follow(ingespy, ingesrs, specs, args, MismatchReporter(args.report, args.report_format, args.sample_cap))
+        return
 
-                elif py_module_state[i]['module_name'] < rs_module_state[j]['module_name']:
-                    logger.error(f"Couldn't find {py_module_state[i]['module_name']} in module_state table of {ingesrs._PG_DB}")
-                    i+=1
+    ingespy.begin_snapshot_session()
+    ingesrs.begin_snapshot_session()
 
+    state = load_state(args.state_file) if args.incremental else {"tables": {}, "module_state": {}}
+    validated_modules = {}
+    reporter = MismatchReporter(args.report, args.report_format, args.sample_cap, track_heights=args.sample_heights > 0)
+    metrics = RunMetrics()
+    started = time.perf_counter()
 
-                elif py_module_state[i]['module_name'] > rs_module_state[j]['module_name']:
-                    logger.error(f"Couldn't find {rs_module_state[j]['module_name']} in module_state table of {ingespy._PG_DB}")
-                    j+=1
+    #scans may replace the connections after a failure, see IndexerDatabase.reconnect, so they aren't used as context managers
+    with ingespy.conn.cursor(cursor_factory=RealDictCursor) as py_cursor, ingesrs.conn.cursor(cursor_factory=RealDictCursor) as rs_cursor:
+        #(table_name, by_height) for every table to validate, the keys are looked up in the registry
+        tasks = chain_tables(registry, state_tables)
 
-            while i<len(py_module_state):
+        #for checking state tables of different modules at the latest height
+        py_cursor.execute("""
+                        SELECT *
+                        FROM module_state
+                        ORDER BY module_name COLLATE "C";
+                        """)
+        py_module_state = py_cursor.fetchall()
+        rs_cursor.execute("""
+                        SELECT *
+                        FROM module_state
+                        ORDER BY module_name COLLATE "C";
+                        """)
+        rs_module_state = rs_cursor.fetchall()
+
+        i=0
+        j=0
+            
+        while i<len(py_module_state) and j<len(rs_module_state):
+            if py_module_state[i]['module_name'] == rs_module_state[j]['module_name']:
+                if py_module_state[i]['last_update_height'] == rs_module_state[j]['last_update_height']:
+                    module_name = py_module_state[i]['module_name']
+                    last_update_height = py_module_state[i]['last_update_height']
+                    validated_modules[module_name] = last_update_height
+                    #state tables are rewritten in place, so they are fully validated again once last_update_height moves
+                    if args.incremental and state["module_state"].get(module_name) == last_update_height:
+                        logger.info(f"Skipping {module_name} state, last_update_height {last_update_height} was already validated")
+                    elif module_name in registry:
+                        #validated as a whole even if it has a height column, rows of every height may have been rewritten
+                        tasks.append((module_name, False))
+                    else:
+                        logger.error(f"Couldn't find a {module_name} table in both databases to validate the {module_name} state")
+                else:
+                    logger.error(f"Inconsistent last_update_height for {py_module_state[i]['module_name']}: {ingespy._PG_DB}: {py_module_state[i]['last_update_height']}, {ingesrs._PG_DB}: {rs_module_state[j]['last_update_height']}")
+                i+=1
+                j+=1
+
+            elif py_module_state[i]['module_name'] < rs_module_state[j]['module_name']:
                 logger.error(f"Couldn't find {py_module_state[i]['module_name']} in module_state table of {ingesrs._PG_DB}")
                 i+=1
-            while j<len(rs_module_state):
+
+
+            elif py_module_state[i]['module_name'] > rs_module_state[j]['module_name']:
                 logger.error(f"Couldn't find {rs_module_state[j]['module_name']} in module_state table of {ingespy._PG_DB}")
                 j+=1
 
+        while i<len(py_module_state):
+            logger.error(f"Couldn't find {py_module_state[i]['module_name']} in module_state table of {ingesrs._PG_DB}")
+            i+=1
+        while j<len(rs_module_state):
+            logger.error(f"Couldn't find {rs_module_state[j]['module_name']} in module_state table of {ingespy._PG_DB}")
+            j+=1
 
+        #the remaining tables, e.g. account_txns, hold neither chain data nor module state and are validated as a whole
+        scheduled = {table_name for table_name, _ in tasks}
+        tasks += [(spec.name, False) for spec in registry.values()
+                  if spec.name not in scheduled and spec.name not in state_tables and spec.name != "module_state"]
 
-            py_cursor.execute("""
-                            SELECT *
-                            FROM account_txns
-                            ORDER BY address;
-                            """)
-            py_account_txns = py_cursor.fetchall()
-            rs_cursor.execute("""
-                            SELECT *
-                            FROM account_txns
-                            ORDER BY address;
-                            """)
-            rs_account_txns = rs_cursor.fetchall()
-
-            check_lists(py_account_txns, rs_account_txns, ["address"], "account_txns", ingespy._PG_DB, ingesrs._PG_DB)
-
-            # i=0
-            # j=0
-
-            # while i<len(py_account_txns) and j<len(rs_account_txns):
-            #     if py_account_txns[i]['address'] < rs_account_txns[j]['address']:
-            #         logger.error(f"Couldn't find the address {py_account_txns[i]['address']} in account_txns table of {ingesrs._PG_DB}")
-            #         i+=1
-            #     elif py_account_txns[i]['address'] > rs_account_txns[j]['account']:
-            #         logger.error(f"Couldn't find the address {rs_account_txns[j]['account']} in account_txns table of {ingespy._PG_DB}")
-            #         j+=1
-            #     else:
-            #         for key in py_account_txns[i]:
-            #             if key != 'rowid' and py_account_txns[i].get(key) != rs_account_txns[j].get(key):
-            #                 logger.error(f"Inconsistent {key} for address {py_account_txns[i]['address']} in account_txns table")
-            #         i+=1
-            #         j+=1
-
-            # while i<len(py_account_txns):
-            #     logger.error(f"Couldn't find the address {py_account_txns[i]['address']} in account_txns table of {ingesrs._PG_DB}")
-            #     i+=1
-            # while j<len(rs_account_txns):
-            #     logger.error(f"Couldn't find the address {rs_account_txns[j]['account']} in account_txns table of {ingespy._PG_DB}")
-            #     j+=1
-
-            logger.info("Validator script finished!")
+        if args.incremental:
+            #heights above the common height may still be in flight on one of the indexers, they are left for the next run
+            common_height = get_common_height(py_cursor, rs_cursor)
+            incremental_tasks = []
+            for table_name, by_height in tasks:
+                if not by_height and table_name not in HEIGHT_FILTERS:
+                    incremental_tasks.append((table_name, by_height))
+                    continue
+                if common_height is None:
+                    continue
+                lo = max(state["tables"].get(table_name, -1) + 1 - args.overlap, 0)
+                if lo <= common_height:
+                    incremental_tasks.append((table_name, by_height, (lo, common_height + 1)))
+            tasks = incremental_tasks
+
+        if args.sample_heights:
+            #the same heights and keys are validated on both sides, heights are drawn from those both indexers have reached
+            height_bounds = get_height_bounds(py_cursor, rs_cursor)
+            common_height = get_common_height(py_cursor, rs_cursor)
+            heights = []
+            if height_bounds is not None and common_height is not None:
+                population = range(height_bounds[0], common_height + 1)
+                heights = sorted(random.Random(args.seed).sample(population, min(args.sample_heights, len(population))))
+            logger.info(f"Sampling {len(heights)} heights and {args.sample_fraction:.2%} of the keys of the other tables")
+            sampled_tasks = []
+            for table_name, by_height in tasks:
+                if by_height or table_name in HEIGHT_FILTERS:
+                    if heights:
+                        sampled_tasks.append((table_name, by_height, heights))
+                else:
+                    sampled_tasks.append((table_name, by_height, KeySample(args.seed, args.sample_fraction)))
+            tasks = sampled_tasks
+
+        if args.shards > 1:
+            sharded_tasks = []
+            for table_name, by_height, *height_range in tasks:
+                if not by_height:
+                    sharded_tasks.append((table_name, by_height, *height_range))
+                    continue
+                for shard_range in get_shard_ranges(py_cursor, rs_cursor, table_name, args.shards, args.shard_split, *height_range):
+                    sharded_tasks.append((table_name, by_height, shard_range))
+            tasks = sharded_tasks
+
+        if args.workers > 1:
+            py_snapshot = export_snapshot(py_cursor)
+            rs_snapshot = export_snapshot(rs_cursor)
+            #the exported snapshots stay valid as long as this transaction is open, i.e. until the pool is done
+            with multiprocessing.Pool(args.workers, initializer=init_worker,
+                                      initargs=(ingespy.connect_args(), ingesrs.connect_args(), py_snapshot, rs_snapshot, registry, args)) as pool:
+                #shards of a table are merged into the same per-table counts
+                for report, worker_metrics in pool.imap_unordered(validate_task_in_worker, tasks):
+                    reporter.absorb(*report)
+                    metrics.absorb(worker_metrics)
+        else:
+            set_context(ingespy, ingesrs, registry, args, reporter, metrics)
+            for task in tasks:
+                validate_table(*task)
+
+        mismatches = reporter.close()
+        estimates = None
+        if args.sample_heights:
+            height_tables = {task[0] for task in tasks if isinstance(task[2], list)}
+            estimates = estimate_mismatch_rates(metrics, mismatches, reporter.heights, heights, height_tables)
+            for table_name, estimate in estimates.items():
+                if estimate["rate"] is not None:
+                    logger.info(f"{table_name}: estimated mismatch rate {estimate['rate']:.4%} over {estimate['sampled']} sampled {estimate['unit']}, "
+                                f"95% confidence interval [{estimate['low']:.4%}, {estimate['high']:.4%}]")
+        metrics.export(args.metrics_json, args.metrics_prom, time.perf_counter() - started, mismatches, estimates)
+
+        if args.incremental:
+            for table_name, by_height, *height_range in tasks:
+                if height_range:
+                    state["tables"][table_name] = max(state["tables"].get(table_name, -1), height_range[0][1] - 1)
+            state["module_state"].update(validated_modules)
+            save_state(args.state_file, state)
+
+        logger.info("Validator script finished!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()